@@ -1,78 +1,19 @@
+import atexit
+import json
+import logging
+import queue
 import re
+import threading
+import time
+from dataclasses import dataclass
 from datetime import datetime
+from pathlib import Path
 from zoneinfo import ZoneInfo
 
+import numpy as np
 import pandas as pd
 import streamlit as st
-import matplotlib
-import matplotlib.pyplot as plt
-import matplotlib.patheffects as pe
-from matplotlib import font_manager
-
-def setup_korean_font():
-    """
-    Streamlit Cloud(리눅스)에서 Matplotlib 한글 깨짐을 막기 위한 폰트 설정.
-    - 레포의 ./fonts 폴더에 .ttf/.otf를 넣으면 자동으로 탐지/등록합니다.
-    - 없으면 시스템 설치 폰트를 탐색합니다.
-    """
-    try:
-        from pathlib import Path
-        import os
-
-        here = Path(__file__).resolve().parent
-        fonts_dir = here / "fonts"
-
-        # 1) 레포 포함 폰트 자동 탐지
-        if fonts_dir.exists() and fonts_dir.is_dir():
-            font_files = []
-            for ext in ("*.ttf", "*.otf", "*.ttc"):
-                font_files.extend(sorted(fonts_dir.glob(ext)))
-
-            # 선호 키워드(가능하면 한글 폰트 우선)
-            prefer = ["notosanskr", "noto sans kr", "notosanscjk", "nanum", "malgun", "applegothic"]
-            def score(p: Path) -> int:
-                name = p.name.lower()
-                for i, kw in enumerate(prefer):
-                    if kw.replace(" ", "") in name.replace(" ", ""):
-                        return 100 - i
-                return 0
-
-            font_files.sort(key=score, reverse=True)
-
-            for fp in font_files:
-                try:
-                    font_manager.fontManager.addfont(str(fp))
-                    # 캐시를 다시 읽도록 유도(환경에 따라 필요)
-                    try:
-                        font_manager._load_fontmanager(try_read_cache=False)
-                    except Exception:
-                        pass
-
-                    name = font_manager.FontProperties(fname=str(fp)).get_name()
-                    plt.rcParams["font.family"] = name
-                    plt.rcParams["font.sans-serif"] = [name]
-                    plt.rcParams["axes.unicode_minus"] = False
-                    return name
-                except Exception:
-                    continue
-
-        # 2) 시스템 설치 폰트 탐색
-        candidates = ["Malgun Gothic", "AppleGothic", "NanumGothic", "Noto Sans KR", "Noto Sans CJK KR"]
-        for name in candidates:
-            try:
-                _ = font_manager.findfont(font_manager.FontProperties(family=name), fallback_to_default=False)
-                plt.rcParams["font.family"] = name
-                plt.rcParams["font.sans-serif"] = [name]
-                plt.rcParams["axes.unicode_minus"] = False
-                return name
-            except Exception:
-                continue
-
-        plt.rcParams["axes.unicode_minus"] = False
-        return None
-    except Exception:
-        return None
-
+import altair as alt
 
 
 # =========================
@@ -133,6 +74,13 @@ MAIN_SPREADSHEET_ID = str(st.secrets.get("main_sheet_id", DEFAULT_MAIN_SHEET_ID)
 MAIN_GID = int(st.secrets.get("main_gid", DEFAULT_MAIN_GID))
 MAIN_WORKSHEET_NAME = str(st.secrets.get("main_worksheet_name", DEFAULT_MAIN_WORKSHEET_NAME)).strip()
 MAX_DATA_ROWS = int(st.secrets.get("max_data_rows", DEFAULT_MAX_DATA_ROWS))
+SHEET_HEADER_SCAN_ROWS = 50   # 헤더(컬럼) 행을 찾는 상단 행 수
+SHEET_FETCH_LAST_COL = "ZZ"   # 메인 시트 조회 범위의 마지막 열
+# 숫자 셀은 표시 서식(천 단위 콤마 등) 없이 숫자 그대로 받음 → 문자열 파싱 없이 float 변환
+SHEET_VALUE_PARAMS = {"valueRenderOption": "UNFORMATTED_VALUE"}
+# 원본 값은 전체 정밀도이므로 연도(가격) 열은 시트 표시 자릿수로 반올림
+# → 화면에서 같은 가격인 세대가 기존처럼 공동 순위(method="min")를 유지
+SHEET_PRICE_DECIMALS = 2
 
 # 조회 로그 기록용 시트(선택)
 LOG_SPREADSHEET_ID = str(st.secrets.get("log_sheet_id", DEFAULT_LOG_SHEET_ID)).strip()
@@ -161,42 +109,6 @@ ALL_RANK_STYLE = {
     "marker_edge": "#d62728",
     "marker_edge_width": 1.2,
 }
-SEL_PRICE_STYLE = {
-    "line_color": "#2ca02c",
-    "line_width": 2.5,
-    "line_style": "-",
-    "marker": "o",
-    "marker_size": 7,
-    "marker_face": "#ffffff",
-    "marker_edge": "#2ca02c",
-    "marker_edge_width": 1.2,
-}
-CMP_PRICE_STYLE = {
-    "line_color": "#9467bd",
-    "line_width": 2.5,
-    "line_style": "--",
-    "marker": "s",
-    "marker_size": 7,
-    "marker_face": "#ffffff",
-    "marker_edge": "#9467bd",
-    "marker_edge_width": 1.2,
-}
-
-# 레이싱차트 스타일(3번 비교 그래프)
-SEL_BAR_STYLE = {
-    "face_color": "#2ca02c",
-    "edge_color": "#145a32",
-    "linewidth": 1.2,
-    "alpha": 0.85,
-    "hatch": "",
-}
-CMP_BAR_STYLE = {
-    "face_color": "#9467bd",
-    "edge_color": "#4a235a",
-    "linewidth": 1.2,
-    "alpha": 0.85,
-    "hatch": "//",
-}
 
 # 순위 라벨(그래프 숫자)
 SHOW_RANK_LABELS = True
@@ -205,36 +117,8 @@ RANK_LABEL_Y_OFFSET = -22  # (음수일수록 위로 더 올라감)
 RANK_LABEL_BOLD = True
 
 # 표/그래프 높이(좌우 패널 맞춤)
-RANK_PANEL_HEIGHT_PX = 560   # 좌측 표, 우측 그래프를 동일 높이로 맞춤
-RANK_FIG_DPI = 130
-RANK_FIG_HEIGHT_IN = RANK_PANEL_HEIGHT_PX / RANK_FIG_DPI
 RANK_TABLE_ROW_HEIGHT_PX = 24  # CSS로 줄일 행 높이
-
-
-# =========================
-# 한글 폰트 설정 (Matplotlib)
-# =========================
-def set_korean_matplotlib_font() -> str | None:
-    candidates = ["Malgun Gothic", "AppleGothic", "NanumGothic", "Noto Sans KR", "Noto Sans CJK KR"]
-    available = {f.name for f in font_manager.fontManager.ttflist}
-    for name in candidates:
-        if name in available:
-            matplotlib.rcParams["font.family"] = name
-            matplotlib.rcParams["axes.unicode_minus"] = False
-            return name
-    matplotlib.rcParams["axes.unicode_minus"] = False
-    return None
-
-
-# 한글 폰트 설정: 레포 내 ./fonts 폴더 폰트 우선 등록 후, 시스템 폰트로 fallback
-@st.cache_resource(show_spinner=False)
-def init_matplotlib_font() -> str | None:
-    name = setup_korean_font()
-    if not name:
-        name = set_korean_matplotlib_font()
-    return name
-
-_ = init_matplotlib_font()
+RANK_CHART_HEIGHT_PX = 320     # Altair 순위 그래프 높이(2열 레이아웃의 한 칸 기준)
 
 
 # =========================
@@ -244,7 +128,12 @@ st.set_page_config(page_title="압구정 공시가격 랭킹", layout="centered"
 # =========================
 # 배포/실행을 위한 Secrets 검증
 # =========================
-def _validate_runtime_config() -> None:
+@st.cache_resource(show_spinner=False)
+def _missing_runtime_config() -> tuple[str, ...]:
+    """빠진 필수 Secrets 항목. Secrets 조회는 재실행마다가 아니라 프로세스당 1회만 합니다.
+
+    (로컬에서 secrets.toml을 고친 뒤에는 앱을 다시 시작해야 반영됩니다. Cloud는 Secrets 저장 시 재시작됨)
+    """
     missing: list[str] = []
 
     if not MAIN_SPREADSHEET_ID:
@@ -253,7 +142,11 @@ def _validate_runtime_config() -> None:
     has_sa_info = ("gcp_service_account" in st.secrets) or bool(str(st.secrets.get("SERVICE_ACCOUNT_FILE", "")).strip())
     if not has_sa_info:
         missing.append("gcp_service_account 또는 SERVICE_ACCOUNT_FILE")
+    return tuple(missing)
+
 
+def _validate_runtime_config() -> None:
+    missing = _missing_runtime_config()
     if missing:
         st.error(
             "앱 실행에 필요한 Streamlit Secrets 설정이 없습니다(인증 정보가 필요합니다): "
@@ -411,6 +304,7 @@ st.markdown(
 )
 
 YEAR_RE = re.compile(r"^\d{4}$")
+PYEONG_NUM_RE = re.compile(r"(\d+(?:\.\d+)?)")  # '56평' / '56.5평' / '56'의 숫자 부분
 
 
 def tight_height(n_rows: int) -> int:
@@ -420,29 +314,42 @@ def tight_height(n_rows: int) -> int:
     return header + per_row * max(n_rows, 1) + padding
 
 
+def _fast_html_table(header: list[str], rows, css_class: str, row_header: bool = False) -> str:
+    """미리 문자열로 포맷된 셀로 HTML 표를 만듭니다(작은 표용, pandas to_html 대신 사용).
+
+    row_header=True면 각 행의 첫 셀을 <th>로 출력합니다. 셀 값은 이스케이프하지 않습니다.
+    """
+    head = "".join(f"<th>{h}</th>" for h in header)
+    body = []
+    for row in rows:
+        cells = ["" if pd.isna(v) else v for v in row]
+        if row_header and cells:
+            body.append(f"<tr><th>{cells[0]}</th>" + "".join(f"<td>{v}</td>" for v in cells[1:]) + "</tr>")
+        else:
+            body.append("<tr>" + "".join(f"<td>{v}</td>" for v in cells) + "</tr>")
+    return f'<table class="{css_class}"><thead><tr>{head}</tr></thead><tbody>{"".join(body)}</tbody></table>'
+
+
 def render_rank_table_html(df_in: pd.DataFrame) -> None:
     """랭킹 표를 HTML 테이블로 렌더링(가운데 정렬 + 불필요한 빈 행 제거)."""
-    df = df_in.copy()
+    # 바뀌는 컬럼만 새로 만들고 나머지는 원본 컬럼을 그대로 사용(전체 복사 없음)
+    cols = {}
+    if "연도" in df_in.columns:
+        cols["연도"] = pd.to_numeric(df_in["연도"], errors="coerce").astype("Int64")
 
-    if "연도" in df.columns:
-        df["연도"] = pd.to_numeric(df["연도"], errors="coerce").astype("Int64")
+    if "공시가격(억)" in df_in.columns:
+        s = pd.to_numeric(df_in["공시가격(억)"], errors="coerce")
+        cols["공시가격(억)"] = _fmt_prices(s.to_numpy(dtype=np.float64, na_value=np.nan))
 
-    if "공시가격(억)" in df.columns:
-        s = pd.to_numeric(df["공시가격(억)"], errors="coerce")
-        df["공시가격(억)"] = s.map(lambda x: f"{x:.2f}" if pd.notna(x) else "")
+    df = df_in.assign(**cols)
 
     # 표 출력 단계에서 최종 방어(완전 빈 행 제거)
-    df = df.replace({"": pd.NA}).dropna(how="all").copy()
+    df = df.replace({"": pd.NA}).dropna(how="all")
 
-    html = df.to_html(index=False, classes="rank-table", escape=False)
+    html = _fast_html_table(list(df.columns), df.to_numpy(dtype=object), "rank-table")
     st.markdown(html, unsafe_allow_html=True)
 
 
-# =========================
-# Google Sheets Client (Secrets 기반)
-# =========================
-@st.cache_resource(show_spinner=False)
-
 def render_compare_year_table_html(cmp: dict, last_year: str, sel_name: str, cmp_name: str) -> None:
     """선택/비교 대상의 2016 vs 최신연도(보통 2025) 가격/순위를 한눈에 보는 표로 표시.
 
@@ -467,11 +374,11 @@ def render_compare_year_table_html(cmp: dict, last_year: str, sel_name: str, cmp
     )
     df.index.name = "연도"
 
-    disp = df.copy()
+    disp = df  # 이 함수에서 만든 표이므로 복사 없이 표시용 문자열로 변환
     for c in [sel_price_col, cmp_price_col]:
-        disp[c] = disp[c].map(lambda x: f"{float(x):.2f}")
+        disp[c] = _fmt_prices(disp[c].to_numpy(dtype=np.float64))
     for c in [sel_rank_col, cmp_rank_col]:
-        disp[c] = disp[c].map(lambda x: f"{int(x):,}")
+        disp[c] = _fmt_thousands(disp[c].to_numpy(dtype=np.int64))
 
     # 상단에 한 줄 요약(선택/비교 물건명)
     st.markdown(
@@ -480,9 +387,44 @@ def render_compare_year_table_html(cmp: dict, last_year: str, sel_name: str, cmp
         unsafe_allow_html=True,
     )
 
-    html = disp.to_html(classes="summary-table", escape=False)
+    html = _fast_html_table(
+        [disp.index.name, *disp.columns],
+        [(idx, *vals) for idx, vals in zip(disp.index, disp.to_numpy(dtype=object))],
+        "summary-table",
+        row_header=True,
+    )
     st.markdown(html, unsafe_allow_html=True)
 
+
+# =========================
+# Google Sheets Client (Secrets 기반)
+# - 클라이언트(HTTP 세션 포함)는 프로세스 단위로 재사용해 재실행마다 인증/TLS 연결을 새로 맺지 않음
+# =========================
+def _mount_pooled_adapter(gc):
+    """gspread 클라이언트의 HTTP 세션에 커넥션 풀 + 재시도 어댑터를 장착합니다(세션은 인증 정보를 가진 기존 것 사용).
+
+    429(요청 한도)/5xx는 지수 백오프로 최대 3회 재시도합니다. 재시도는 urllib3 기본값대로
+    멱등 메서드(GET 등)에만 적용되어, 로그 append(POST)가 중복 기록되지 않습니다.
+    """
+    session = getattr(getattr(gc, "http_client", None), "session", None) or getattr(gc, "session", None)
+    if session is None or not hasattr(session, "mount"):
+        return gc
+    try:
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+    except Exception:
+        return gc
+    retry = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        raise_on_status=False,  # 마지막 응답은 gspread가 그대로 받아 기존처럼 예외 처리
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+    return gc
+
+
+@st.cache_resource(show_spinner=False)
 def get_gspread_client():
     import gspread
     from google.oauth2.service_account import Credentials
@@ -500,7 +442,7 @@ def get_gspread_client():
         if isinstance(pk, str):
             info["private_key"] = pk.replace("\\n", "\n")
         creds = Credentials.from_service_account_info(info, scopes=scopes)
-        return gspread.authorize(creds)
+        return _mount_pooled_adapter(gspread.authorize(creds))
 
     # 2) 로컬/원본 방식: SERVICE_ACCOUNT_FILE 경로로 인증
     sa_path = str(st.secrets.get("SERVICE_ACCOUNT_FILE", "")).strip()
@@ -511,107 +453,188 @@ def get_gspread_client():
         )
 
     creds = Credentials.from_service_account_file(sa_path, scopes=scopes)
-    return gspread.authorize(creds)
+    return _mount_pooled_adapter(gspread.authorize(creds))
+
+
+@st.cache_resource(ttl=3600, show_spinner=False)
+def _gid_map(spreadsheet_id: str, _sh) -> dict:
+    """spreadsheet_id → {gid: worksheet}. worksheets() 목록 조회를 시간당 1회로 줄입니다."""
+    return {int(w.id): w for w in _sh.worksheets()}
 
 
 def open_worksheet_by_gid(sh, gid: int):
-    ws = None
-    for w in sh.worksheets():
-        if int(w.id) == int(gid):
-            ws = w
-            break
+    ws = _gid_map(sh.id, sh).get(int(gid))
     return ws if ws is not None else sh.sheet1
 
 
+def _resolve_worksheet_title(sh, gid: int) -> str:
+    return open_worksheet_by_gid(sh, gid).title
+
+
+def _a1_range(title: str, n_rows: int, last_col: str = SHEET_FETCH_LAST_COL) -> str:
+    t = str(title).replace("'", "''")
+    return f"'{t}'!A1:{last_col}{n_rows}"
+
+
+def _col_letter(n: int) -> str:
+    """1 → A, 26 → Z, 27 → AA"""
+    s = ""
+    while n > 0:
+        n, r = divmod(n - 1, 26)
+        s = chr(65 + r) + s
+    return s
+
+
+@st.cache_resource(show_spinner=False)
+def _sheet_layout_cache() -> dict:
+    """(spreadsheet_id, gid, worksheet_name) → (헤더 행 위치, 헤더 열 수). 다음 로딩부터 필요한 범위만 조회합니다."""
+    return {}
+
+
 # =========================
 # 유틸
 # =========================
 def _normalize_columns(df: pd.DataFrame) -> pd.DataFrame:
-    df = df.copy()
+    """컬럼명/빈 값 정리. 호출자가 소유한 프레임을 제자리(in-place)에서 수정합니다."""
     df.columns = [str(c).strip() for c in df.columns]
-    df = df.replace({"": pd.NA, " ": pd.NA})
+    df.replace({"": pd.NA, " ": pd.NA}, inplace=True)
 
     # '주소' 컬럼을 내부 표준인 '구역'으로 통일
     if "구역" not in df.columns and "주소" in df.columns:
-        df = df.rename(columns={"주소": "구역"})
+        df.rename(columns={"주소": "구역"}, inplace=True)
 
     # 완전 빈 이름(_col*)으로 들어온 컬럼은 전부 NA인 경우에만 제거
     drop_cols = [c for c in df.columns if str(c).startswith("_col")]
     if drop_cols:
-        drop_cols = [c for c in drop_cols if df[c].isna().all()]
-        if drop_cols:
-            df = df.drop(columns=drop_cols)
+        empty = df[drop_cols].isna().all()
+        df.drop(columns=empty.index[empty].tolist(), inplace=True)
 
     return df
+
+
+def _to_str_or_none(x) -> str | None:
+    s = str(x)
+    return s if s.strip() else None
+
+
+def _to_float_or_none(x) -> float | None:
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return None
+
+
 def _detect_year_cols(df: pd.DataFrame) -> list[str]:
-    year_cols = []
-    for c in df.columns:
-        s = str(c).strip()
-        if YEAR_RE.match(s):
-            year_cols.append(s)
-        else:
-            try:
-                f = float(s)
-                if f.is_integer() and YEAR_RE.match(str(int(f))):
-                    year_cols.append(str(int(f)))
-            except Exception:
-                pass
-    return sorted(set(year_cols), key=lambda x: int(x))
+    return list(_year_cols_from_names(tuple(str(c).strip() for c in df.columns)))
+
+
+@st.cache_data(show_spinner=False)
+def _year_cols_from_names(names: tuple[str, ...]) -> tuple[str, ...]:
+    """컬럼명 목록에서 연도 컬럼(YYYY, 또는 2016.0처럼 정수로 읽히는 값)을 찾아 정렬해 반환합니다."""
+    year_cols = {s for s in names if YEAR_RE.match(s)}
+    for s in names:
+        if s in year_cols:
+            continue
+        try:
+            f = float(s)
+        except ValueError:
+            continue
+        if f.is_integer() and YEAR_RE.match(str(int(f))):
+            year_cols.add(str(int(f)))
+    return tuple(sorted(year_cols, key=int))
 
 
 def _coerce_numeric(df: pd.DataFrame, cols: list[str]) -> pd.DataFrame:
-    df = df.copy()
-    for c in cols:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors="coerce")
+    """연도 컬럼을 숫자(float32)로 변환. 호출자가 소유한 프레임을 제자리(in-place)에서 수정합니다.
+
+    공시가격(억, 소수 2자리)은 float32로 충분하고, 순위 계산 시 읽는 메모리가 절반이 됩니다.
+    """
+    cols = [c for c in cols if c in df.columns]
+    if not cols:
+        return df
+    # 연도 블록을 한 번에 변환(로더가 이미 float64로 만든 열은 to_numeric 생략)
+    block = df[cols]
+    if not all(pd.api.types.is_numeric_dtype(t) for t in block.dtypes):
+        block = block.apply(pd.to_numeric, errors="coerce")
+    df[cols] = block.astype(np.float32)
     return df
 
 
 def _filter_year_cols_with_data(df: pd.DataFrame, year_cols: list[str]) -> list[str]:
-    keep = []
-    for y in year_cols:
-        s = pd.to_numeric(df[y], errors="coerce")
-        if int(s.notna().sum()) > 0:
-            keep.append(y)
-    return keep
+    if not year_cols:
+        return []
+    # 연도 컬럼 전체를 한 번에 검사(이미 숫자형이면 변환 생략)
+    sub = df[list(year_cols)]
+    if not all(pd.api.types.is_numeric_dtype(t) for t in sub.dtypes):
+        sub = sub.apply(pd.to_numeric, errors="coerce")
+    has_data = sub.notna().to_numpy().any(axis=0)
+    return [y for y, ok in zip(year_cols, has_data) if ok]
 
 
 def _clean_main_df(df_raw: pd.DataFrame) -> pd.DataFrame:
-    df = df_raw.copy()
-    df = df.iloc[:MAX_DATA_ROWS].copy()
+    """필수 컬럼 정리 + 키가 빈 행 제거.
+
+    df_raw(로더가 새로 만든 프레임)는 제자리에서 정리하고, 필터링 결과(새 프레임)를 반환합니다.
+    """
+    df = df_raw
+    if len(df) > MAX_DATA_ROWS:
+        df.drop(index=df.index[MAX_DATA_ROWS:], inplace=True)
 
     required = ["구역", "단지명", "동", "호"]
     for c in required:
         if c not in df.columns:
             raise ValueError(f"필수 컬럼이 없습니다: {c} (현재 컬럼: {list(df.columns)})")
 
-    df["구역"] = df["구역"].astype(str).str.strip()
-    df["단지명"] = df["단지명"].astype(str).str.strip()
+    zone_s = df["구역"].astype(str).str.strip()
+    complex_s = df["단지명"].astype(str).str.strip()
     df["동"] = pd.to_numeric(df["동"], errors="coerce").astype("Int64")
     df["호"] = pd.to_numeric(df["호"], errors="coerce").astype("Int64")
 
-    df = df.dropna(subset=["구역", "단지명", "동", "호"]).copy()
-    df = df[(df["구역"].str.lower() != "nan") & (df["단지명"].str.lower() != "nan")].copy()
-    return df
+    keep = (
+        df[["동", "호"]].notna().all(axis=1)
+        & (zone_s.str.lower() != "nan")
+        & (complex_s.str.lower() != "nan")
+    )
 
+    # 구역/단지명은 반복되는 짧은 문자열이므로 category로 보관(== 비교/groupby가 정수 코드 비교로 처리됨)
+    # - 카테고리는 남는 행의 값만, 정렬된 순서로 지정 → 코드 순서 = 문자열 정렬 순서
+    df["구역"] = pd.Categorical(zone_s, categories=sorted(zone_s[keep].unique()))
+    df["단지명"] = pd.Categorical(complex_s, categories=sorted(complex_s[keep].unique()))
+    # 남은 행은 동/호가 모두 있으므로 nullable Int64 대신 int32로 보관(마스킹 없는 numpy 비교/조회)
+    return df[keep].astype({"동": np.int32, "호": np.int32})
+
+
+def _fmt_thousands(vals: np.ndarray) -> np.ndarray:
+    """0 이상 정수 배열을 천 단위 콤마 문자열 배열로 변환(셀 단위 파이썬 포맷 없이 3자리 그룹별 벡터 연산)."""
+    cur = np.asarray(vals, dtype=np.int64)
+    tail = np.full(cur.shape, "", dtype="<U32")
+    while True:
+        big = cur >= 1000
+        if not big.any():
+            break
+        tail = np.where(big, np.char.add(np.char.add(",", np.char.mod("%03d", cur % 1000)), tail), tail)
+        cur = np.where(big, cur // 1000, cur)
+    return np.char.add(np.char.mod("%d", cur), tail)
 
-def _fmt_rank(rank, total) -> str:
-    if pd.isna(rank) or pd.isna(total):
-        return ""
-    return f"{int(rank):,}/{int(total):,}"
 
+def _fmt_prices(vals: np.ndarray) -> np.ndarray:
+    """가격 배열을 소수 2자리 문자열 배열로 변환(NaN은 빈 문자열)."""
+    arr = np.asarray(vals, dtype=np.float64)
+    out = np.full(arr.shape, "", dtype=object)
+    ok = ~np.isnan(arr)
+    out[ok] = np.char.mod("%.2f", arr[ok])
+    return out
 
-def _parse_rank_text(s: str) -> int | None:
-    if s is None or (isinstance(s, float) and pd.isna(s)):
-        return None
-    txt = str(s).strip()
-    if not txt:
-        return None
-    try:
-        left = txt.split("/")[0].replace(",", "").strip()
-        return int(left)
-    except Exception:
-        return None
+
+def _fmt_ranks(vec: np.ndarray, total) -> np.ndarray:
+    """순위 배열을 '순위/전체' 문자열 배열로 한 번에 변환(NaN은 빈 문자열)."""
+    out = np.full(len(vec), "", dtype=object)
+    if pd.isna(total):
+        return out
+    valid = ~np.isnan(vec)
+    total_s = _fmt_thousands(np.array([int(total)]))[0]
+    out[valid] = np.char.add(_fmt_thousands(vec[valid]), "/" + total_s)
+    return out
 
 
 def infer_floor_from_ho(ho: int) -> int | None:
@@ -651,6 +674,19 @@ def _fmt_pyeong(pyeong_val) -> str:
         return f"{s}평"
 
 
+def _pyeong_sort_key(s: str) -> float:
+    """평형 표시값의 숫자 부분(정렬용). 숫자가 없으면 맨 뒤로 보냅니다."""
+    m = PYEONG_NUM_RE.search(s if isinstance(s, str) else str(s))
+    return float(m.group(1)) if m else 999999.0
+
+
+def _uniquify_labels(labels: list[str]) -> list[str]:
+    """중복 라벨의 두 번째부터 '(2)', '(3)'…을 붙여 구분합니다(groupby.cumcount로 한 번에 처리)."""
+    s = pd.Series(labels, dtype=object)
+    n = s.groupby(s, sort=False).cumcount()
+    return np.where(n == 0, s, s + "(" + (n + 1).astype(str) + ")").tolist()
+
+
 def unit_str_pyeong_floor_only(zone: str, complex_name: str, pyeong_val, dong: int, ho: int) -> str:
     floor = infer_floor_from_ho(ho)
     floor_txt = f"{floor}층" if floor is not None else "층?"
@@ -669,16 +705,10 @@ def get_pyeong_value(df_num: pd.DataFrame, zone: str, complex_name: str, dong: i
     pcol = detect_pyeong_col(df_num)
     if pcol is None:
         return pd.NA
-    m = (
-        (df_num["구역"] == zone)
-        & (df_num["단지명"] == complex_name)
-        & (df_num["동"] == dong)
-        & (df_num["호"] == ho)
-    )
-    sub = df_num.loc[m, pcol]
-    if sub.empty:
+    pos = find_row_pos(df_num, zone, complex_name, dong, ho)
+    if pos is None:
         return pd.NA
-    return sub.iloc[0]
+    return df_num[pcol].iat[pos]
 
 
 def legend_unit_label(zone: str, pyeong_val, dong: int, ho: int) -> str:
@@ -688,6 +718,11 @@ def legend_unit_label(zone: str, pyeong_val, dong: int, ho: int) -> str:
     return f"{zone} {_fmt_pyeong(pyeong_val)} {dong}동/{floor_txt}"
 
 def infer_device_type() -> str:
+    # 세션 동안 User-Agent는 바뀌지 않으므로 첫 판별 결과를 세션 상태에 보관(재실행마다 헤더 파싱 생략, 레이아웃도 고정)
+    cached = st.session_state.get("device_type")
+    if cached is not None:
+        return cached
+
     ua = ""
     try:
         ua = (st.context.headers or {}).get("User-Agent", "")  # type: ignore[attr-defined]
@@ -696,7 +731,9 @@ def infer_device_type() -> str:
 
     ua_l = (ua or "").lower()
     mobile_keys = ["mobi", "android", "iphone", "ipad", "ipod", "windows phone"]
-    return "mobile" if any(k in ua_l for k in mobile_keys) else "desktop"
+    device = "mobile" if any(k in ua_l for k in mobile_keys) else "desktop"
+    st.session_state["device_type"] = device
+    return device
 
 
 def format_ho_for_log(ho: int) -> str:
@@ -707,6 +744,100 @@ def format_ho_for_log(ho: int) -> str:
     return f"{ho_i}호" if ho_i >= 1000 else str(ho_i)
 
 
+LOG_FLUSH_INTERVAL_SEC = 5   # 첫 로그 이후 이 시간 동안 모인 행을 한 번에 기록
+LOG_FLUSH_MAX_ROWS = 50      # 한 번에 기록할 최대 행 수
+LOG_REOPEN_AFTER_FAILURES = 3  # 연속 실패가 이 횟수에 이르면 워크시트 핸들을 다시 resolve
+_LOG_STOP = object()         # 종료 시 큐 맨 뒤에 넣는 표식: 앞에 쌓인 행까지 기록하고 스레드 종료
+LOG_HEADER = ["date_ymd", "time", "device", "zone", "dong", "ho", "event"]
+logger = logging.getLogger(__name__)
+
+
+@st.cache_resource(show_spinner=False)
+def _log_worksheet():
+    """로그 워크시트 핸들(헤더 확인 포함). 프로세스당 1회만 resolve 합니다."""
+    gc = get_gspread_client()
+    sh = gc.open_by_key(LOG_SPREADSHEET_ID)
+    ws = open_worksheet_by_gid(sh, LOG_GID)
+
+    try:
+        header = ws.row_values(1)
+    except Exception:
+        header = []
+
+    if [h.strip() for h in header] != LOG_HEADER:
+        if not any(header):
+            ws.update("A1:G1", [LOG_HEADER])
+    return ws
+
+
+@st.cache_resource(show_spinner=False)
+def _log_status() -> dict:
+    """백그라운드 로그 기록 실패 집계(프로세스 공유). 기록 스레드만 갱신하고, 화면에서는 읽기만 합니다."""
+    return {"failed_rows": 0, "last_error": ""}
+
+
+def _log_writer_loop(q: "queue.Queue", ws, status: dict) -> None:
+    stop = False
+    consecutive_failures = 0
+    while not stop:
+        rows = []
+        item = q.get()
+        deadline = time.monotonic() + LOG_FLUSH_INTERVAL_SEC
+        while True:
+            if item is _LOG_STOP:
+                stop = True
+                break
+            rows.append(item)
+            remaining = deadline - time.monotonic()
+            if len(rows) >= LOG_FLUSH_MAX_ROWS or remaining <= 0:
+                break
+            try:
+                item = q.get(timeout=remaining)
+            except queue.Empty:
+                break
+
+        if not rows:
+            continue
+        try:
+            ws.append_rows(rows, value_input_option="USER_ENTERED")
+            consecutive_failures = 0
+        except Exception as e:
+            status["last_error"] = str(e)
+            status["failed_rows"] += len(rows)
+            logger.warning("조회 로그 %d건 기록 실패: %s", len(rows), e)
+            consecutive_failures += 1
+            if consecutive_failures >= LOG_REOPEN_AFTER_FAILURES:
+                # 시트 삭제/권한 변경 등으로 핸들이 무효가 된 경우 대비: 캐시를 비우고 다시 resolve
+                consecutive_failures = 0
+                _log_worksheet.clear()
+                try:
+                    ws = _log_worksheet()
+                except Exception as e2:
+                    status["last_error"] = str(e2)
+                    logger.warning("조회 로그 워크시트 재연결 실패: %s", e2)
+
+
+def _flush_log_on_exit(q: "queue.Queue", t: threading.Thread) -> None:
+    # 프로세스 정상 종료 시 버퍼에 남은 행을 기록할 기회를 줌(네트워크 지연에 대비해 대기 시간 제한)
+    q.put_nowait(_LOG_STOP)
+    t.join(timeout=LOG_FLUSH_INTERVAL_SEC + 10)
+
+
+@st.cache_resource(show_spinner=False)
+def _log_queue() -> "queue.Queue":
+    """조회 로그 버퍼. 프로세스당 1개의 백그라운드 스레드가 모아서 append_rows로 기록합니다.
+
+    워크시트는 여기(스크립트 스레드)에서 resolve 해서 넘기므로, 권한/설정 오류는 호출한 쪽에서 드러납니다.
+    정상 종료 시에는 atexit에서 남은 행을 기록하고, 강제 종료(SIGKILL 등) 시에는 버퍼 분량이 유실될 수 있습니다.
+    """
+    ws = _log_worksheet()
+    q = queue.Queue()
+    t = threading.Thread(target=_log_writer_loop, args=(q, ws, _log_status()), name="lookup-log-writer", daemon=True)
+    t.start()
+    atexit.register(_flush_log_on_exit, q, t)
+    return q
+
+
 def append_lookup_log(zone: str, dong: int, ho: int, complex_name: str, event: str = "조회") -> None:
     # log_sheet_id가 없으면 로그 기록을 건너뜁니다.
     if not LOG_SPREADSHEET_ID:
@@ -728,58 +859,81 @@ def append_lookup_log(zone: str, dong: int, ho: int, complex_name: str, event: s
         event_text,
     ]
 
-    gc = get_gspread_client()
-    sh = gc.open_by_key(LOG_SPREADSHEET_ID)
-    ws = open_worksheet_by_gid(sh, LOG_GID)
+    # 시트 기록은 백그라운드 스레드가 모아서 처리(클릭 경로에서 네트워크 왕복 제거)
+    _log_queue().put_nowait(row)
 
-    try:
-        header = ws.row_values(1)
-    except Exception:
-        header = []
-
-    expected_header = ["date_ymd", "time", "device", "zone", "dong", "ho", "event"]
-    if [h.strip() for h in header] != expected_header:
-        if not any(header):
-            ws.update("A1:G1", [expected_header])
 
-    ws.append_row(row, value_input_option="USER_ENTERED")
+def notify_log_failures() -> None:
+    """이 세션이 시작된 뒤 백그라운드 로그 기록이 새로 실패했으면 다음 실행에서 알림(같은 실패는 한 번만)."""
+    if not LOG_SPREADSHEET_ID:
+        return
+    status = _log_status()
+    failed = status["failed_rows"]
+    seen = st.session_state.setdefault("log_failed_seen", failed)
+    if failed > seen:
+        st.session_state["log_failed_seen"] = failed
+        st.toast(f"조회 로그 {failed - seen}건 기록 실패(권한/시트 설정 확인 필요): {status['last_error']}", icon="⚠️")
 
 
 # =========================
 # 구글시트 로딩 (헤더 2행)
 # =========================
-@st.cache_data(show_spinner=False, ttl=600)
+# 헤더(컬럼) 행 자동 탐지: '구역' 또는 '주소'를 모두 지원
+HEADER_MUST_HAVE_SETS = [
+    {"구역", "단지명", "동", "호"},
+    {"주소", "단지명", "동", "호"},  # 일부 시트에서 '구역' 대신 '주소' 사용
+]
+
+
+def _is_header_row(row: list) -> bool:
+    s = {str(x).strip() for x in row}
+    return any(ms.issubset(s) for ms in HEADER_MUST_HAVE_SETS)
+
+
 def load_from_gsheet(spreadsheet_id: str, gid: int = 0, worksheet_name: str | None = None) -> pd.DataFrame:
     gc = get_gspread_client()
     sh = gc.open_by_key(spreadsheet_id)
 
-    # 우선순위: worksheet_name(탭 이름) → gid
-    ws = None
-    if worksheet_name:
-        try:
-            ws = sh.worksheet(worksheet_name)
-        except Exception:
-            ws = None
-    if ws is None:
-        ws = open_worksheet_by_gid(sh, gid)
+    def _fetch(n_rows: int, last_col: str) -> list:
+        # 우선순위: worksheet_name(탭 이름) → gid
+        if worksheet_name:
+            try:
+                return sh.values_get(_a1_range(worksheet_name, n_rows, last_col), params=SHEET_VALUE_PARAMS).get("values", [])
+            except Exception:
+                pass
+        title = _resolve_worksheet_title(sh, gid)
+        return sh.values_get(_a1_range(title, n_rows, last_col), params=SHEET_VALUE_PARAMS).get("values", [])
+
+    # 이전 로딩에서 찾은 헤더 위치/열 수가 있으면 그 범위만 조회(헤더 열 수 + 1열까지 받아
+    # 열이 추가됐는지 확인). 헤더가 바뀌었으면 아래 전체 탐색으로 다시 찾음
+    layout_key = (spreadsheet_id, int(gid), worksheet_name or "")
+    layout = _sheet_layout_cache().get(layout_key)
+    values = None
+    header_row_index = None
+    if layout is not None:
+        h, n_cols = layout
+        values = _fetch(h + 1 + MAX_DATA_ROWS, _col_letter(n_cols + 1))
+        if len(values) > h and len(values[h]) == n_cols and _is_header_row(values[h]):
+            header_row_index = h
+        else:
+            _sheet_layout_cache().pop(layout_key, None)
+            values = None
+
+    if values is None:
+        # 헤더 탐색 구간 + 데이터 최대 행까지를 values.get 한 번으로 가져옴
+        values = _fetch(MAX_DATA_ROWS + SHEET_HEADER_SCAN_ROWS, SHEET_FETCH_LAST_COL)
+        for i, row in enumerate(values[:SHEET_HEADER_SCAN_ROWS]):  # 상단 50행 내에서 탐색
+            if _is_header_row(row):
+                header_row_index = i
+                _sheet_layout_cache()[layout_key] = (i, len(row))
+                break
 
-    values = ws.get_all_values()
     if not values:
         raise ValueError("시트에 데이터가 없습니다.")
 
-    # 헤더(컬럼) 행 자동 탐지: '구역' 또는 '주소'를 모두 지원
-    header_row_index = None
-    must_have_sets = [
-        {"구역", "단지명", "동", "호"},
-        {"주소", "단지명", "동", "호"},  # 일부 시트에서 '구역' 대신 '주소' 사용
-    ]
-
-    for i, row in enumerate(values[:50]):  # 상단 50행 내에서 탐색
-        cells = [str(x).strip() for x in row]
-        s = set(cells)
-        if any(ms.issubset(s) for ms in must_have_sets):
-            header_row_index = i
-            break
+    # values.get은 행 끝의 빈 셀을 생략하므로 get_all_values처럼 직사각형으로 맞춤
+    width = max(len(r) for r in values)
+    values = [r + [""] * (width - len(r)) if len(r) < width else r for r in values]
 
     # 그래도 못 찾으면: 1행을 헤더로 간주(데이터 1행을 헤더로 오인하지 않도록 2행 fallback 금지)
     if header_row_index is None:
@@ -788,58 +942,415 @@ def load_from_gsheet(spreadsheet_id: str, gid: int = 0, worksheet_name: str | No
     header = [str(x).strip() if str(x).strip() else f"_col{j}" for j, x in enumerate(values[header_row_index])]
     data = values[header_row_index + 1:]
 
-    df = pd.DataFrame(data, columns=header)
-    return _normalize_columns(df)
+    # object 문자열 DataFrame을 거치지 않고 Arrow 배열로 바로 구성
+    # - 구역/단지명: dictionary 인코딩(pandas에서는 category)
+    # - 동/호/연도: float64 (숫자가 아니면 null, 연도 가격은 SHEET_PRICE_DECIMALS 자리로 반올림)
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    arrays = []
+    for j, name in enumerate(header):
+        col = [row[j] if j < len(row) else "" for row in data]
+        if name in ("구역", "주소", "단지명"):
+            arrays.append(pa.array([_to_str_or_none(x) for x in col], type=pa.string()).dictionary_encode())
+        elif name in ("동", "호"):
+            arrays.append(pa.array([_to_float_or_none(x) for x in col], type=pa.float64()))
+        elif YEAR_RE.match(name):
+            arr = pa.array([_to_float_or_none(x) for x in col], type=pa.float64())
+            arrays.append(pc.round(arr, SHEET_PRICE_DECIMALS, round_mode="half_towards_infinity"))
+        else:
+            arrays.append(pa.array([_to_str_or_none(x) for x in col], type=pa.string()))
+
+    table = pa.table(arrays, names=header)
+    return _normalize_columns(table.to_pandas())
+# =========================
+# 정리된 데이터 로컬 캐시 (Parquet)
+# - 콜드 스타트 시 구글시트 조회/정리를 건너뛰기 위해 df_num을 디스크에 보관합니다.
+# - 시트 설정이 바뀌었거나 DF_CACHE_TTL_SEC가 지나면 무시하고 다시 읽습니다.
+# =========================
+DF_CACHE_DIR = Path(__file__).resolve().parent / ".cache"
+DF_CACHE_TTL_SEC = 600
+
+
+def _df_cache_source() -> dict:
+    return {
+        "sheet_id": MAIN_SPREADSHEET_ID,
+        "gid": MAIN_GID,
+        "worksheet": MAIN_WORKSHEET_NAME,
+        "max_rows": MAX_DATA_ROWS,
+    }
+
+
+def read_df_num_cache() -> tuple[pd.DataFrame, list[str]] | None:
+    try:
+        meta = json.loads((DF_CACHE_DIR / "meta.json").read_text(encoding="utf-8"))
+        if meta.get("source") != _df_cache_source():
+            return None
+        if time.time() - float(meta["ts"]) >= DF_CACHE_TTL_SEC:
+            return None
+        return pd.read_parquet(DF_CACHE_DIR / "df_num.parquet"), list(meta["year_cols"])
+    except Exception:
+        return None
+
+
+def write_df_num_cache(df_num: pd.DataFrame, year_cols: list[str]) -> None:
+    # 캐시 기록 실패(읽기 전용 파일시스템 등)는 앱 동작에 영향을 주지 않도록 무시
+    try:
+        DF_CACHE_DIR.mkdir(exist_ok=True)
+        tmp = DF_CACHE_DIR / "df_num.parquet.tmp"
+        df_num.to_parquet(tmp)
+        tmp.replace(DF_CACHE_DIR / "df_num.parquet")
+        meta = {"ts": time.time(), "year_cols": list(year_cols), "source": _df_cache_source()}
+        (DF_CACHE_DIR / "meta.json").write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+    except Exception:
+        pass
+
+
 # =========================
 # 랭킹 계산
 # =========================
-def compute_rank_tables(df_num: pd.DataFrame, year_cols: list[str], zone: str, complex_name: str, dong: int, ho: int):
-    pick = df_num[
-        (df_num["구역"] == zone)
-        & (df_num["단지명"] == complex_name)
-        & (df_num["동"] == dong)
-        & (df_num["호"] == ho)
+# 순위는 데이터 로딩 후 전체 연도를 한 번에 계산(precompute_ranks)하고, 클릭 시에는 위치 인덱스로 조회만 함
+RANK_KERNEL_MIN_ROWS = 2000  # 이보다 작은 행렬(구역 부분집합 등)은 JIT 없이 numpy 정렬로 충분
+
+# 순위 행렬 커널(선택): numba가 설치되어 있으면 연도(열)별 정렬/순위 부여를 여러 코어에서 병렬로 수행
+try:
+    from numba import njit, prange
+
+    @njit(parallel=True, cache=True)
+    def _rank_matrix_kernel(mat, out):
+        n, y = mat.shape
+        for j in prange(y):
+            key = np.empty(n)
+            for i in range(n):
+                v = mat[i, j]
+                key[i] = -v if v == v else np.inf  # NaN은 맨 뒤로
+            order = np.argsort(key)
+            run_start = 0
+            for r in range(n):
+                i = order[r]
+                if r > 0 and key[i] != key[order[r - 1]]:
+                    run_start = r
+                out[i, j] = run_start + 1 if key[i] != np.inf else np.nan
+except Exception:
+    # numba 미설치, 또는 데코레이션 실패(캐시 위치 없음/읽기 전용 설치 경로 등) → 아래 numpy 경로 사용
+    _rank_matrix_kernel = None
+
+
+def _rank_matrix(mat: np.ndarray) -> np.ndarray:
+    """(N, Y) 가격 행렬의 열(연도)별 내림차순 공동 순위(method="min")를 한 번에 계산합니다.
+
+    정렬 후 같은 가격 구간의 시작 위치를 순위로 사용하므로 동점은 같은 순위를 가집니다.
+    NaN(가격 없음)은 맨 뒤로 보내 순위에서 제외하고 결과도 NaN. 반환은 float32(순위 값은 정확히 표현됨).
+    """
+    n = mat.shape[0]
+    if _rank_matrix_kernel is not None and n >= RANK_KERNEL_MIN_ROWS:
+        try:
+            ranks = np.empty(mat.shape, dtype=np.float32)
+            _rank_matrix_kernel(np.ascontiguousarray(mat), ranks)
+            return ranks
+        except Exception:
+            pass  # JIT 컴파일/캐시 로딩 실패 시 아래 numpy 경로로 계산
+
+    missing = np.isnan(mat)
+    key = np.where(missing, np.inf, -mat)
+    order = np.argsort(key, axis=0, kind="stable")
+    sorted_key = np.take_along_axis(key, order, axis=0)
+
+    new_run = np.ones(sorted_key.shape, dtype=bool)
+    new_run[1:] = sorted_key[1:] != sorted_key[:-1]
+    run_start = np.where(new_run, np.arange(n)[:, None], 0)
+    np.maximum.accumulate(run_start, axis=0, out=run_start)
+
+    ranks = np.empty(mat.shape, dtype=np.float32)
+    np.put_along_axis(ranks, order, (run_start + 1).astype(np.float32), axis=0)
+    ranks[missing] = np.nan
+    return ranks
+
+
+def _row_key(zone, complex_name, dong, ho) -> tuple:
+    return (str(zone), str(complex_name), int(dong), int(ho))
+
+
+def _build_rank_index(df_num: pd.DataFrame, year_cols: tuple[str, ...]):
+    """연도별 압구정 전체/구역 내 순위 배열과 (구역, 단지명, 동, 호) → 위치 인덱스를 계산합니다.
+
+    반환: (all_ranks, zone_ranks, row_index, zone_row_index, all_mat)
+      - all_ranks[y]: df_num 행 순서의 전체 순위 배열(all_mat의 행 뷰)
+      - zone_ranks[(zone, y)]: 해당 구역 행들만의 구역 내 순위 배열
+      - row_index[key] / zone_row_index[key]: 각 배열에서의 위치(중복 키는 첫 행)
+      - all_mat: (연도, 행) float32 전체 순위 행렬(year_cols 순서). 여러 연도×여러 행을 한 번에 인덱싱할 때 사용
+    """
+    mat = df_num.reindex(columns=list(year_cols)).to_numpy(dtype=np.float32, na_value=np.nan)
+    # 연도별 배열이 연속 메모리가 되도록 (Y, N)으로 전치해 보관
+    all_mat = np.ascontiguousarray(_rank_matrix(mat).T)
+    all_ranks = {y: all_mat[j] for j, y in enumerate(year_cols)}
+
+    keys = [
+        _row_key(z, c, d, h) if pd.notna(d) and pd.notna(h) else None
+        for z, c, d, h in zip(df_num["구역"], df_num["단지명"], df_num["동"], df_num["호"])
     ]
-    if pick.empty:
+    # 역순으로 채워서 중복 키는 첫 행이 남도록 함(기존 마스크 조회의 첫 행 선택과 동일)
+    row_index = {k: i for i, k in reversed(list(enumerate(keys))) if k is not None}
+
+    zone_ranks, zone_row_index = {}, {}
+    for z, pos in df_num.groupby("구역", observed=True, sort=False).indices.items():
+        zmat = np.ascontiguousarray(_rank_matrix(mat[pos]).T)
+        for j, y in enumerate(year_cols):
+            zone_ranks[(str(z), y)] = zmat[j]
+        for zp in range(len(pos) - 1, -1, -1):
+            k = keys[pos[zp]]
+            if k is not None:
+                zone_row_index[k] = zp
+
+    return all_ranks, zone_ranks, row_index, zone_row_index, all_mat
+
+
+@st.cache_data(show_spinner=False)
+def precompute_ranks(df_num: pd.DataFrame, year_cols: tuple[str, ...]):
+    """_build_rank_index의 캐시 버전(로더가 만든 MainData 이외의 프레임용)."""
+    return _build_rank_index(df_num, year_cols)
+
+
+# =========================
+# 메인 데이터셋 (모든 세션이 공유)
+# - st.cache_resource로 프레임을 직렬화/복사 없이 그대로 공유하므로 df는 읽기 전용으로만 사용합니다.
+# =========================
+@dataclass(frozen=True)
+class MainData:
+    df: pd.DataFrame
+    year_cols: list[str]  # 화면에 사용하는 연도(2016년~, 데이터가 있는 연도)
+    ranks_all: dict
+    ranks_by_zone: dict
+    key_to_pos: dict
+    zone_key_to_pos: dict
+    zone_indices: dict  # 구역 → 해당 구역 행 위치(iloc) 배열
+    zone_dong_meta: dict  # 구역 → (동 선택 목록 [(단지명, 동)], 동 번호만으로 구분 가능 여부)
+    ho_lists: dict  # (구역, 단지명, 동) → 정렬된 호 목록
+    rank_mat: np.ndarray  # (연도, 행) 전체 순위 행렬. ranks_all[y]는 이 행렬의 행 뷰
+    rank_year_row: dict  # 연도 → rank_mat 행 번호
+
+
+@st.cache_resource(show_spinner=False)
+def _main_data_by_id() -> dict:
+    """id(df) → MainData. df_num만 받는 함수들이 미리 계산된 순위/인덱스를 찾는 데 사용합니다."""
+    return {}
+
+
+@st.cache_resource(show_spinner=False, ttl=600)
+def load_main_dataset(spreadsheet_id: str, gid: int = 0, worksheet_name: str | None = None) -> MainData:
+    cached = read_df_num_cache()
+    if cached is not None:
+        df_num, year_cols = cached
+    else:
+        try:
+            df_raw = load_from_gsheet(spreadsheet_id, gid, worksheet_name)
+        except Exception as e:
+            raise RuntimeError(f"구글시트 로딩 실패: {e}") from e
+
+        try:
+            df = _clean_main_df(df_raw)
+        except Exception as e:
+            raise RuntimeError(f"데이터 정리 실패: {e}") from e
+
+        year_cols_all = _detect_year_cols(df)
+        # df는 _clean_main_df가 새로 만든 프레임이므로 복사 없이 제자리 변환(df_num과 df는 같은 객체)
+        df_num = _coerce_numeric(df, year_cols_all)
+        year_cols = _filter_year_cols_with_data(df_num, year_cols_all)
+        # 요청: 공시가격은 2016년부터 사용
+        year_cols = [y for y in year_cols if int(y) >= 2016]
+        if not year_cols:
+            raise RuntimeError("연도 컬럼은 있으나 실제 데이터가 있는 연도가 없습니다.")
+
+        write_df_num_cache(df_num, year_cols)
+
+    rank_years = tuple(_detect_year_cols(df_num))
+    ranks_all, ranks_by_zone, key_to_pos, zone_key_to_pos, rank_mat = _build_rank_index(df_num, rank_years)
+    zone_indices = {str(z): pos for z, pos in df_num.groupby("구역", observed=True, sort=False).indices.items()}
+    zone_dong_meta = {z: _dong_meta(df_num.take(pos)) for z, pos in zone_indices.items()}
+    data = MainData(
+        df_num, year_cols, ranks_all, ranks_by_zone, key_to_pos, zone_key_to_pos, zone_indices, zone_dong_meta,
+        _build_ho_lists(df_num), rank_mat, {y: j for j, y in enumerate(rank_years)},
+    )
+
+    reg = _main_data_by_id()
+    with _DF_REGISTRY_LOCK:
+        while len(reg) >= DF_REGISTRY_MAX:
+            reg.pop(next(iter(reg)), None)
+        reg[id(df_num)] = data
+    return data
+
+
+def refresh_main_data() -> None:
+    """메인 데이터 캐시(메모리 + 디스크 Parquet)를 비워 다음 실행에서 구글시트를 다시 읽게 합니다."""
+    load_main_dataset.clear()
+    try:
+        (DF_CACHE_DIR / "meta.json").unlink(missing_ok=True)
+    except Exception:
+        pass
+
+
+def _main_data_for(df_num: pd.DataFrame) -> MainData | None:
+    data = _main_data_by_id().get(id(df_num))
+    return data if (data is not None and data.df is df_num) else None
+
+
+def rank_index(df_num: pd.DataFrame):
+    """df_num의 (ranks_all, ranks_by_zone, key_to_pos, zone_key_to_pos)를 반환합니다.
+
+    로더가 만든 프레임이면 MainData에 보관된 것을 그대로 쓰고, 아니면 precompute_ranks로 계산합니다.
+    """
+    data = _main_data_for(df_num)
+    if data is not None:
+        return data.ranks_all, data.ranks_by_zone, data.key_to_pos, data.zone_key_to_pos
+    return precompute_ranks(df_num, tuple(_detect_year_cols(df_num)))[:4]
+
+
+def rank_matrix(df_num: pd.DataFrame) -> tuple[np.ndarray, dict]:
+    """(연도, 행) 전체 순위 행렬과 연도 → 행 번호. rank_mat[np.ix_(연도 행들, 위치들)]처럼 한 번에 인덱싱합니다."""
+    data = _main_data_for(df_num)
+    if data is not None:
+        return data.rank_mat, data.rank_year_row
+    year_cols = tuple(_detect_year_cols(df_num))
+    return precompute_ranks(df_num, year_cols)[4], {y: j for j, y in enumerate(year_cols)}
+
+
+def zone_rows(df_num: pd.DataFrame, zone) -> np.ndarray:
+    """구역에 속한 행 위치(iloc) 배열. MainData가 있으면 전체 스캔 없이 미리 만든 인덱스를 사용합니다."""
+    data = _main_data_for(df_num)
+    if data is not None:
+        return data.zone_indices.get(str(zone), np.empty(0, dtype=np.intp))
+    return np.flatnonzero((df_num["구역"] == zone).to_numpy(dtype=bool))
+
+
+def _dong_meta(zone_df: pd.DataFrame) -> tuple[list, bool]:
+    dong_pairs = (
+        zone_df[["단지명", "동"]]
+        .dropna()
+        .drop_duplicates()
+        .sort_values(["단지명", "동"])
+        .to_records(index=False)
+        .tolist()
+    )
+
+    # 같은 구역 내에서 '동' 값이 단지명과 1:1이면, 화면에는 '동'만 노출(요청사항: 구역/동/호)
+    # 만약 같은 '동'이 여러 단지에 존재하면 혼동 방지를 위해 단지명도 함께 표기합니다.
+    dongs = np.fromiter((int(x[1]) for x in dong_pairs), dtype=np.int64, count=len(dong_pairs))
+    _dong_only_ok = (np.unique(dongs).size == dongs.size) if dongs.size else True
+    return dong_pairs, bool(_dong_only_ok)
+
+
+def _ho_list(rows: pd.DataFrame) -> list[int]:
+    # np.unique가 정렬+중복 제거를 한 번에 수행
+    arr = rows["호"].to_numpy(dtype=np.float64, na_value=np.nan)
+    return np.unique(arr[~np.isnan(arr)].astype(np.int64)).tolist()
+
+
+def _build_ho_lists(df_num: pd.DataFrame) -> dict:
+    sub = df_num[["구역", "단지명", "동", "호"]].dropna(subset=["구역", "단지명", "동"])
+    return {
+        (str(z), str(c), int(d)): _ho_list(g)
+        for (z, c, d), g in sub.groupby(["구역", "단지명", "동"], observed=True, sort=False)
+    }
+
+
+def dong_ho_list(df_num: pd.DataFrame, zone, complex_name, dong) -> list[int]:
+    """(구역, 단지명, 동)의 호 선택 목록. MainData가 있으면 로딩 시 만든 목록을 조회만 합니다."""
+    data = _main_data_for(df_num)
+    if data is not None:
+        return data.ho_lists.get((str(zone), str(complex_name), int(dong)), [])
+    # 연도 열까지 복사하지 않도록 필요한 키 열만 골라서 구역 행을 가져옴
+    zdf = df_num[["단지명", "동", "호"]].take(zone_rows(df_num, zone))
+    return _ho_list(zdf[(zdf["단지명"] == complex_name) & (zdf["동"] == dong)])
+
+
+def zone_dong_meta(df_num: pd.DataFrame, zone) -> tuple[list, bool]:
+    """구역의 (동 선택 목록, 동 번호만으로 구분 가능 여부). MainData가 있으면 로딩 시 만든 값을 그대로 사용합니다."""
+    data = _main_data_for(df_num)
+    if data is not None and str(zone) in data.zone_dong_meta:
+        return data.zone_dong_meta[str(zone)]
+    return _dong_meta(df_num[["단지명", "동"]].take(zone_rows(df_num, zone)))
+
+
+def find_row_pos(df_num: pd.DataFrame, zone, complex_name, dong, ho) -> int | None:
+    """(구역, 단지명, 동, 호) 키의 df_num 내 위치(iloc)를 반환합니다. 없으면 None."""
+    try:
+        key = _row_key(zone, complex_name, dong, ho)
+    except (TypeError, ValueError):
+        return None
+    _, _, row_index, _ = rank_index(df_num)
+    return row_index.get(key)
+
+
+def _rank_for_years(df_num: pd.DataFrame, years: list[str], zone: str, complex_name: str, dong: int, ho: int):
+    """선택 행의 연도별 가격과 구역 내/압구정 전체 순위를 numpy 배열로 반환합니다.
+
+    순위는 '해당 연도 가격이 더 높은 행 수 + 1'(공동 순위, method="min")이며,
+    precompute_ranks에서 미리 계산한 배열을 위치 인덱스로 조회만 합니다. 없는 연도/가격은 NaN.
+    반환: (prices, zone_ranks, all_ranks, zone_n, all_n)
+    """
+    year_all = tuple(_detect_year_cols(df_num))
+    _, zone_r, row_index, zone_row_index = rank_index(df_num)
+    key = _row_key(zone, complex_name, dong, ho)
+    if key not in row_index:
         raise ValueError("선택한 조건의 행을 찾지 못했습니다.")
-    pick_row = pick.iloc[0]
+    pos, zpos = row_index[key], zone_row_index[key]
+
+    prices = df_num.iloc[pos].reindex(list(years)).to_numpy(dtype=np.float64, na_value=np.nan)
+    # 전체 순위는 (연도, 행) 순위 행렬에서 선택 행의 모든 연도를 한 번에 인덱싱
+    rank_mat, year_row = rank_matrix(df_num)
+    yrows = np.array([year_row.get(y, -1) for y in years], dtype=np.intp)
+    has_year = yrows >= 0
+    all_ranks = np.full(len(yrows), np.nan)
+    all_ranks[has_year] = rank_mat[yrows[has_year], pos]
+    zone_ranks = np.array(
+        [zone_r[(key[0], y)][zpos] if (key[0], y) in zone_r else np.nan for y in years], dtype=np.float64
+    )
 
-    zone_df = df_num[df_num["구역"] == zone].copy()
-    all_df = df_num.copy()
+    zone_n = len(zone_r[(key[0], year_all[0])]) if year_all else int((df_num["구역"] == zone).sum())
+    return prices, zone_ranks, all_ranks, zone_n, int(len(df_num))
 
-    zone_n = int(zone_df.shape[0])
-    all_n = int(all_df.shape[0])
 
-    key_mask_zone = (zone_df["단지명"] == complex_name) & (zone_df["동"] == dong) & (zone_df["호"] == ho)
-    key_mask_all = (all_df["구역"] == zone) & (all_df["단지명"] == complex_name) & (all_df["동"] == dong) & (all_df["호"] == ho)
+def compute_rank_tables(df_num: pd.DataFrame, year_cols: list[str], zone: str, complex_name: str, dong: int, ho: int):
+    """선택 세대의 (구역 내 랭킹 표, 압구정 전체 랭킹 표, 구역 내 그래프 데이터, 전체 그래프 데이터).
+
+    그래프 데이터는 순위가 있는 연도만 담은 연도 오름차순 {"연도", "rank"}(int32) 프레임입니다.
+    같은 선택의 재실행에서는 캐시된 결과를 그대로 사용합니다.
+    """
+    return _compute_rank_tables(
+        register_df_num(df_num), tuple(year_cols), str(zone), str(complex_name), int(dong), int(ho)
+    )
 
-    zone_rows, all_rows = [], []
-    for y in year_cols:
-        zone_rank_series = zone_df[y].rank(method="min", ascending=False)
-        all_rank_series = all_df[y].rank(method="min", ascending=False)
 
-        zr = zone_rank_series[key_mask_zone]
-        ar = all_rank_series[key_mask_all]
+@st.cache_data(ttl=600, show_spinner=False)
+def _compute_rank_tables(df_key: str, year_cols: tuple, zone: str, complex_name: str, dong: int, ho: int):
+    df_num = _df_num_registry()[df_key]
+    prices, zone_ranks, all_ranks, zone_n, all_n = _rank_for_years(df_num, year_cols, zone, complex_name, dong, ho)
 
-        price = pd.to_numeric(pick_row.get(y, pd.NA), errors="coerce")
-        if pd.isna(price):
-            continue  # 데이터 없는 연도는 행을 생성하지 않음
-        zone_rank = zr.iloc[0] if (len(zr) and pd.notna(zr.iloc[0])) else pd.NA
-        all_rank = ar.iloc[0] if (len(ar) and pd.notna(ar.iloc[0])) else pd.NA
+    has_price = ~np.isnan(prices)  # 데이터 없는 연도는 행을 생성하지 않음
+    years_out = [int(y) for y, ok in zip(year_cols, has_price) if ok]
+    prices = prices[has_price]
 
-        zone_rows.append({"연도": int(y), "공시가격(억)": price, "구역 내 랭킹": _fmt_rank(zone_rank, zone_n)})
-        all_rows.append({"연도": int(y), "공시가격(억)": price, "압구정 전체 랭킹": _fmt_rank(all_rank, all_n)})
+    # 순위 문자열은 연도별 루프 없이 한 번에 포맷
+    zone_rank_txt = _fmt_ranks(zone_ranks[has_price], zone_n)
+    all_rank_txt = _fmt_ranks(all_ranks[has_price], all_n)
 
-    zone_table = pd.DataFrame(zone_rows)
-    all_table = pd.DataFrame(all_rows)
+    zone_table = pd.DataFrame({"연도": years_out, "공시가격(억)": prices, "구역 내 랭킹": zone_rank_txt})
+    all_table = pd.DataFrame({"연도": years_out, "공시가격(억)": prices, "압구정 전체 랭킹": all_rank_txt})
 
-    zone_table = zone_table.dropna(subset=["공시가격(억)"]).copy()
-    zone_table = zone_table[zone_table["구역 내 랭킹"].astype(str).str.strip() != ""].copy()
+    zone_table = zone_table.dropna(subset=["공시가격(억)"])
+    zone_table = zone_table[zone_table["구역 내 랭킹"].astype(str).str.strip() != ""]
 
-    all_table = all_table.dropna(subset=["공시가격(억)"]).copy()
-    all_table = all_table[all_table["압구정 전체 랭킹"].astype(str).str.strip() != ""].copy()
+    all_table = all_table.dropna(subset=["공시가격(억)"])
+    all_table = all_table[all_table["압구정 전체 랭킹"].astype(str).str.strip() != ""]
 
-    return zone_table, all_table
+    # 그래프용 순위는 표의 문자열을 다시 파싱하지 않고 순위 배열에서 바로 int32로 한 번에 변환
+    years_arr = np.asarray(years_out, dtype=np.int32)
+    plots = []
+    for ranks in (zone_ranks[has_price], all_ranks[has_price]):
+        ok = ~np.isnan(ranks)
+        plot = pd.DataFrame({"연도": years_arr[ok], "rank": ranks[ok].astype(np.int32)})
+        plots.append(plot.sort_values("연도", kind="stable", ignore_index=True))
+    return zone_table, all_table, plots[0], plots[1]
 
 
 # =========================
@@ -849,29 +1360,30 @@ def find_closest_by_2016(df_num: pd.DataFrame, base_zone: str, base_key: tuple,
     if year2016 not in df_num.columns:
         return None
 
-    sel_zone, sel_complex, sel_dong, sel_ho = base_key
-    base_row = df_num[
-        (df_num["구역"] == sel_zone)
-        & (df_num["단지명"] == sel_complex)
-        & (df_num["동"] == sel_dong)
-        & (df_num["호"] == sel_ho)
-    ]
-    if base_row.empty:
+    base_pos = find_row_pos(df_num, *base_key)
+    if base_pos is None:
         return None
 
-    base_price = pd.to_numeric(base_row.iloc[0][year2016], errors="coerce")
+    base_price = df_num[year2016].iat[base_pos]
     if pd.isna(base_price):
         return None
 
-    cand = df_num.copy()
-    cand = cand[cand["구역"] != base_zone].copy()
-    cand["p2016"] = pd.to_numeric(cand[year2016], errors="coerce")
-    cand = cand.dropna(subset=["p2016"]).copy()
-    if cand.empty:
+    # df_num은 읽기만 하므로 복사/컬럼 추가 없이 numpy 배열로 차이를 계산
+    p2016 = df_num[year2016].to_numpy(dtype="float64", na_value=np.nan)
+    diff = np.abs(p2016 - float(base_price))
+    # 기준 구역 제외는 미리 만든 구역 행 인덱스로(전체 행 구역 비교 생략)
+    diff[np.isnan(diff)] = np.inf
+    diff[zone_rows(df_num, base_zone)] = np.inf
+    best_pos = int(np.argmin(diff))
+    if not np.isfinite(diff[best_pos]):
         return None
 
-    cand["diff"] = (cand["p2016"] - base_price).abs()
-    best = cand.sort_values(["diff", "구역", "단지명", "동", "호"]).iloc[0]
+    # 동일 차이가 여러 개면 기존과 같이 (구역, 단지명, 동, 호) 순으로 첫 행 선택(키 열만 정렬)
+    tied = np.flatnonzero(diff == diff[best_pos])
+    if tied.size > 1:
+        keys = df_num[["구역", "단지명", "동", "호"]].iloc[tied].reset_index(drop=True)
+        best_pos = int(tied[keys.sort_values(["구역", "단지명", "동", "호"], kind="stable").index[0]])
+    best = df_num.iloc[best_pos]
 
     return {
         "base_price": float(base_price),
@@ -879,12 +1391,39 @@ def find_closest_by_2016(df_num: pd.DataFrame, base_zone: str, base_key: tuple,
         "cmp_complex": str(best["단지명"]),
         "cmp_dong": int(best["동"]),
         "cmp_ho": int(best["호"]),
-        "cmp_price": float(best["p2016"]),
-        "diff": float(best["diff"]),
+        "cmp_price": float(p2016[best_pos]),
+        "diff": float(diff[best_pos]),
     }
 
 
 
+DF_REGISTRY_MAX = 4  # 보관할 df_num 버전 수(TTL 갱신 직후 이전 버전을 쓰는 세션 대비)
+_DF_REGISTRY_LOCK = threading.Lock()
+
+
+@st.cache_resource(show_spinner=False)
+def _df_num_registry() -> dict:
+    """지문(fingerprint) → df_num 보관소. 캐시 함수에 프레임 대신 짧은 키만 넘기기 위해 사용합니다."""
+    return {}
+
+
+def register_df_num(df_num: pd.DataFrame) -> str:
+    """df_num의 내용 지문을 계산해 보관소에 등록하고 그 키를 반환합니다."""
+    reg = _df_num_registry()
+    for key, registered in list(reg.items()):
+        if registered is df_num:  # 이미 등록된 같은 객체면 전체 해시를 다시 계산하지 않음
+            return key
+
+    h = int(pd.util.hash_pandas_object(df_num, index=True).sum()) & 0xFFFFFFFFFFFFFFFF
+    key = f"{len(df_num)}x{df_num.shape[1]}:{h:016x}"
+    with _DF_REGISTRY_LOCK:  # 보관소는 프로세스 공용이라 여러 세션이 동시에 확인·삭제·등록할 수 있음
+        if key not in reg:
+            while len(reg) >= DF_REGISTRY_MAX:
+                reg.pop(next(iter(reg)), None)
+            reg[key] = df_num
+    return key
+
+
 def find_candidates_by_2016_with_rank_inversion(
     df_num: pd.DataFrame,
     base_zone: str,
@@ -892,9 +1431,13 @@ def find_candidates_by_2016_with_rank_inversion(
     year2016: str = "2016",
     last_year: str = "2025",
     require_inversion: bool = True,
+    top_n: int | None = None,
 ) -> pd.DataFrame:
     """(타구역) 2016 유사 + 순위 역전 후보들을 계산하여 DataFrame으로 반환합니다.
 
+    같은 데이터/조건의 재실행(rerun)에서는 캐시된 결과를 그대로 사용합니다.
+    top_n을 주면 정렬 순서상 앞쪽 top_n개만 계산해 반환합니다(전체 정렬 생략).
+
     반환 DataFrame 컬럼(주요):
       - cmp_zone, cmp_complex, cmp_dong, cmp_ho
       - diff_price_2016 (2016 가격 차이, 절대값)
@@ -902,94 +1445,135 @@ def find_candidates_by_2016_with_rank_inversion(
       - cmp_price_2016, cmp_rank_2016, cmp_price_last, cmp_rank_last
       - base_price_2016, base_rank_2016, base_price_last, base_rank_last
     """
+    return _compute_inversion_candidates(
+        register_df_num(df_num), base_zone, tuple(base_key), year2016, last_year, require_inversion, top_n
+    )
+
+
+@st.cache_data(ttl=600, show_spinner=False)
+def _compute_inversion_candidates(
+    df_key: str,
+    base_zone: str,
+    base_key: tuple,
+    year2016: str,
+    last_year: str,
+    require_inversion: bool,
+    top_n: int | None = None,
+) -> pd.DataFrame:
+    df_num = _df_num_registry()[df_key]
     if year2016 not in df_num.columns or last_year not in df_num.columns:
         return pd.DataFrame()
 
-    sel_zone, sel_complex, sel_dong, sel_ho = base_key
-    base_row = df_num[
-        (df_num["구역"] == sel_zone)
-        & (df_num["단지명"] == sel_complex)
-        & (df_num["동"] == sel_dong)
-        & (df_num["호"] == sel_ho)
-    ]
-    if base_row.empty:
+    base_pos = find_row_pos(df_num, *base_key)
+    if base_pos is None:
         return pd.DataFrame()
 
-    base_idx = base_row.index[0]
-    base_p2016 = pd.to_numeric(base_row.iloc[0].get(year2016, pd.NA), errors="coerce")
-    base_plast = pd.to_numeric(base_row.iloc[0].get(last_year, pd.NA), errors="coerce")
+    # 연도 컬럼은 로딩 시 _coerce_numeric에서 float32로 변환되어 있으므로 그대로 읽음
+    base_p2016 = df_num[year2016].iat[base_pos]
+    base_plast = df_num[last_year].iat[base_pos]
     if pd.isna(base_p2016) or pd.isna(base_plast):
         return pd.DataFrame()
 
-    all_df = df_num.copy()
     # 평형 컬럼 탐색(있으면 후보 리스트 표시에 활용)
     pyeong_col = None
     for _c in ["평형", "평형(평)", "평", "평형_평", "평형평"]:
-        if _c in all_df.columns:
+        if _c in df_num.columns:
             pyeong_col = _c
             break
-    r2016 = all_df[year2016].rank(method="min", ascending=False)
-    rlast = all_df[last_year].rank(method="min", ascending=False)
+    all_r, _, _, _ = rank_index(df_num)
+    r2016 = all_r[year2016].astype(np.float64)
+    rlast = all_r[last_year].astype(np.float64)
 
-    base_r2016 = r2016.loc[base_idx]
-    base_rlast = rlast.loc[base_idx]
-    if pd.isna(base_r2016) or pd.isna(base_rlast):
+    base_r2016 = r2016[base_pos]
+    base_rlast = rlast[base_pos]
+    if np.isnan(base_r2016) or np.isnan(base_rlast):
         return pd.DataFrame()
 
-    cand = all_df[all_df["구역"] != base_zone].copy()
-    cand["p2016"] = pd.to_numeric(cand.get(year2016), errors="coerce")
-    cand["plast"] = pd.to_numeric(cand.get(last_year), errors="coerce")
-    cand["r2016"] = r2016.loc[cand.index]
-    cand["rlast"] = rlast.loc[cand.index]
-    cand = cand.dropna(subset=["p2016", "plast", "r2016", "rlast"]).copy()
-    if cand.empty:
+    # df_num에 컬럼을 추가하지 않고, 필요한 열만 numpy 배열로 한 번씩 꺼내 후보 위치(pos)로 인덱싱
+    # (연도 컬럼은 _coerce_numeric에서 이미 숫자형, 기준 구역 제외는 미리 만든 구역 행 인덱스 사용)
+    p2016 = df_num[year2016].to_numpy(dtype=np.float64, na_value=np.nan)
+    plast = df_num[last_year].to_numpy(dtype=np.float64, na_value=np.nan)
+    ok = ~(np.isnan(p2016) | np.isnan(plast) | np.isnan(r2016) | np.isnan(rlast))
+    ok[zone_rows(df_num, base_zone)] = False
+    pos = np.flatnonzero(ok)
+    if pos.size == 0:
         return pd.DataFrame()
 
-    diff_2016 = base_r2016 - cand["r2016"]
-    diff_last = base_rlast - cand["rlast"]
+    diff_2016 = base_r2016 - r2016[pos]
+    diff_last = base_rlast - rlast[pos]
 
     # 역전 여부: 2016과 last_year 사이에 (선택-후보) 상대 순위차의 부호가 뒤집힘
-    cand["is_inversion"] = ((diff_2016 != 0) & (diff_last != 0) & ((diff_2016 * diff_last) < 0)).astype(int)
+    is_inversion = ((diff_2016 != 0) & (diff_last != 0) & ((diff_2016 * diff_last) < 0)).astype(int)
 
     if require_inversion:
-        cand = cand[cand["is_inversion"] == 1].copy()
-        if cand.empty:
+        keep = is_inversion == 1
+        pos, diff_2016, diff_last, is_inversion = pos[keep], diff_2016[keep], diff_last[keep], is_inversion[keep]
+        if pos.size == 0:
             return pd.DataFrame()
 
-    cand["diff_price_2016"] = (cand["p2016"] - base_p2016).abs()
-    cand["cand_rank_change_abs"] = (cand["rlast"] - cand["r2016"]).abs()
-    cand["relative_rank_swing"] = (diff_last - diff_2016).abs()
+    # 정렬 키를 numpy 배열로 먼저 만들고, 정렬 순서(order)를 구한 뒤 그 순서로 열을 구성
+    cmp_zone = np.asarray(df_num["구역"].iloc[pos].astype(str), dtype=object)
+    cmp_complex = np.asarray(df_num["단지명"].iloc[pos].astype(str), dtype=object)
+    cmp_dong = df_num["동"].to_numpy(dtype=np.int64)[pos]
+    cmp_ho = df_num["호"].to_numpy(dtype=np.int64)[pos]
+    cmp_p2016, cmp_plast = p2016[pos], plast[pos]
+    cmp_r2016, cmp_rlast = r2016[pos], rlast[pos]
+    diff_price_2016 = np.abs(cmp_p2016 - float(base_p2016))
+    cand_rank_change_abs = np.abs(cmp_rlast - cmp_r2016)
+    relative_rank_swing = np.abs(diff_last - diff_2016)
 
-    cand_out = pd.DataFrame(
+    # 정렬: 2016 유사(가까움) 우선 + 같은 유사도에서는 상대변동 큰 후보를 위로
+    sel = np.arange(pos.size)
+    if top_n is not None and pos.size > top_n:
+        # 상위 top_n만 필요하면 2016 차이의 top_n번째 값을 O(N)으로 찾아, 그 값 이하(동점 포함)만 정렬
+        kth = np.partition(diff_price_2016, top_n - 1)[top_n - 1]
+        sel = np.flatnonzero(diff_price_2016 <= kth)
+    order = sel[
+        np.lexsort(
+            (
+                cmp_ho[sel],
+                cmp_dong[sel],
+                cmp_complex[sel],
+                cmp_zone[sel],
+                -cand_rank_change_abs[sel],
+                -relative_rank_swing[sel],
+                diff_price_2016[sel],
+            )
+        )
+    ]
+    if top_n is not None:
+        order = order[:top_n]
+
+    # 열별 numpy 배열(SoA)을 dtype을 정해 먼저 만들고, DataFrame은 복사 없이 감싸기만 함
+    n = order.size
+    arrays = {
+        "year2016": np.full(n, year2016, dtype=object),
+        "last_year": np.full(n, last_year, dtype=object),
+        "base_price_2016": np.full(n, base_p2016, dtype=np.float64),
+        "base_rank_2016": np.full(n, base_r2016, dtype=np.float64),
+        "base_price_last": np.full(n, base_plast, dtype=np.float64),
+        "base_rank_last": np.full(n, base_rlast, dtype=np.float64),
+        "base_rank_change_abs": np.full(n, abs(base_rlast - base_r2016), dtype=np.float64),
+        "cmp_zone": cmp_zone[order],
+        "cmp_complex": cmp_complex[order],
+        "cmp_dong": cmp_dong[order],
+        "cmp_ho": cmp_ho[order],
+    }
+    if pyeong_col is not None:
+        arrays["cmp_pyeong"] = df_num[pyeong_col].to_numpy()[pos[order]]
+    arrays.update(
         {
-            "year2016": year2016,
-            "last_year": last_year,
-            "base_price_2016": float(base_p2016),
-            "base_rank_2016": float(base_r2016),
-            "base_price_last": float(base_plast),
-            "base_rank_last": float(base_rlast),
-            "base_rank_change_abs": float(abs(base_rlast - base_r2016)),
-            "cmp_zone": cand["구역"].astype(str),
-            "cmp_complex": cand["단지명"].astype(str),
-            "cmp_dong": cand["동"].astype(int),
-            "cmp_ho": cand["호"].astype(int),
-            "cmp_pyeong": (cand[pyeong_col] if pyeong_col is not None else pd.NA),
-            "cmp_price_2016": cand["p2016"].astype(float),
-            "cmp_rank_2016": cand["r2016"].astype(float),
-            "cmp_price_last": cand["plast"].astype(float),
-            "cmp_rank_last": cand["rlast"].astype(float),
-            "is_inversion": cand["is_inversion"].astype(int),
-            "diff_price_2016": cand["diff_price_2016"].astype(float),
-            "cand_rank_change_abs": cand["cand_rank_change_abs"].astype(float),
-            "relative_rank_swing": cand["relative_rank_swing"].astype(float),
+            "cmp_price_2016": cmp_p2016[order],
+            "cmp_rank_2016": cmp_r2016[order],
+            "cmp_price_last": cmp_plast[order],
+            "cmp_rank_last": cmp_rlast[order],
+            "is_inversion": is_inversion[order],
+            "diff_price_2016": diff_price_2016[order],
+            "cand_rank_change_abs": cand_rank_change_abs[order],
+            "relative_rank_swing": relative_rank_swing[order],
         }
     )
-
-    # 정렬: 2016 유사(가까움) 우선 + 같은 유사도에서는 상대변동 큰 후보를 위로
-    cand_out = cand_out.sort_values(
-        ["diff_price_2016", "relative_rank_swing", "cand_rank_change_abs", "cmp_zone", "cmp_complex", "cmp_dong", "cmp_ho"],
-        ascending=[True, False, False, True, True, True, True],
-    ).reset_index(drop=True)
+    cand_out = pd.DataFrame(arrays, copy=False)
 
     return cand_out
 
@@ -1015,14 +1599,12 @@ def find_closest_by_2016_with_rank_inversion(
         base_key=base_key,
         year2016=year2016,
         last_year=last_year,
+        top_n=max(1, int(top_n_closest)),
     )
     if cand.empty:
         return None
 
-    top_n = max(1, int(top_n_closest))
-    cand_top = cand.head(top_n) if len(cand) > top_n else cand
-
-    best = cand_top.sort_values(
+    best = cand.sort_values(
         ["relative_rank_swing", "cand_rank_change_abs", "diff_price_2016"],
         ascending=[False, False, True],
     ).iloc[0]
@@ -1050,222 +1632,49 @@ def find_closest_by_2016_with_rank_inversion(
         "diff_price_2016": float(best["diff_price_2016"]),
         "relative_rank_swing": float(best["relative_rank_swing"]),
     }
-def build_price_series(df_num: pd.DataFrame, year_cols: list[str], zone: str, complex_name: str, dong: int, ho: int):
-    row = df_num[
-        (df_num["구역"] == zone)
-        & (df_num["단지명"] == complex_name)
-        & (df_num["동"] == dong)
-        & (df_num["호"] == ho)
-    ]
-    if row.empty:
-        return [], []
-    r = row.iloc[0]
-    years, prices = [], []
-    for y in year_cols:
-        v = pd.to_numeric(r.get(y, pd.NA), errors="coerce")
-        if pd.notna(v):
-            years.append(int(y))
-            prices.append(float(v))
-    return years, prices
 
 
 # =========================
 # 차트
+# - 순위 라인은 브라우저에서 그리는 Altair 스펙(rank_line_chart)을 사용합니다(서버 래스터화 없음).
 # =========================
-def plot_rank_line(years: list[int], ranks: list[int], title: str, style: dict):
-    fig, ax = plt.subplots(figsize=(7.0, RANK_FIG_HEIGHT_IN), dpi=RANK_FIG_DPI)
+def rank_line_chart(years: list[int], ranks: list[int], title: str, style: dict):
+    """순위 변화 라인 차트(Altair/Vega-Lite).
 
-    ax.plot(
-        years, ranks,
-        color=style["line_color"],
-        linewidth=style["line_width"],
-        linestyle=style["line_style"],
-        marker=style["marker"],
-        markersize=style["marker_size"],
-        markerfacecolor=style["marker_face"],
-        markeredgecolor=style["marker_edge"],
-        markeredgewidth=style["marker_edge_width"],
+    브라우저에서 그려지는 작은 JSON 스펙이라 서버에서 PNG 래스터화/한글 폰트 처리가 필요 없습니다.
+    """
+    src = pd.DataFrame({"연도": years, "순위": ranks})
+    base = alt.Chart(src).encode(
+        x=alt.X("연도:O", title="연도", axis=alt.Axis(labelAngle=0)),
+        y=alt.Y("순위:Q", title="순위 (작을수록 상위)", scale=alt.Scale(reverse=True, zero=False)),
     )
-
-    ax.set_title(title)
-    ax.set_xlabel("연도")
-    ax.set_ylabel("순위 (작을수록 상위)")
-    ax.set_xticks(years)
-    ax.set_xticklabels([str(y) for y in years], rotation=0)
-    ax.invert_yaxis()
+    chart = base.mark_line(
+        color=style["line_color"],
+        strokeWidth=style["line_width"],
+        strokeDash=[6, 4] if style["line_style"] == "--" else [1, 0],
+        point=alt.OverlayMarkDef(
+            shape="square" if style["marker"] == "s" else "circle",
+            filled=True,
+            fill=style["marker_face"],
+            stroke=style["marker_edge"],
+            strokeWidth=style["marker_edge_width"],
+            size=style["marker_size"] ** 2 * 2,
+        ),
+    ).encode(tooltip=["연도:O", alt.Tooltip("순위:Q", format=",")])
 
     if SHOW_RANK_LABELS:
-        for x, y in zip(years, ranks):
-            ax.annotate(
-                f"{y}",
-                xy=(x, y),
-                xytext=(0, RANK_LABEL_Y_OFFSET),
-                textcoords="offset points",
-                ha="center",
-                va="bottom",
-                fontsize=RANK_LABEL_FONTSIZE,
-                fontweight="bold",
-                bbox=dict(boxstyle="round,pad=0.18", facecolor="white", edgecolor="none", alpha=0.9),
-            )
-
-    ax.grid(True, alpha=0.3)
-    fig.tight_layout()
-    return fig
-
-
-def plot_price_compare(years: list[int], sel_prices: list[float], cmp_prices: list[float],
-                       sel_label: str, cmp_label: str):
-    fig, ax = plt.subplots(figsize=(7.0, RANK_FIG_HEIGHT_IN), dpi=RANK_FIG_DPI)
-
-    ax.plot(
-        years, sel_prices,
-        color=SEL_PRICE_STYLE["line_color"],
-        linewidth=SEL_PRICE_STYLE["line_width"],
-        linestyle=SEL_PRICE_STYLE["line_style"],
-        marker=SEL_PRICE_STYLE["marker"],
-        markersize=SEL_PRICE_STYLE["marker_size"],
-        markerfacecolor=SEL_PRICE_STYLE["marker_face"],
-        markeredgecolor=SEL_PRICE_STYLE["marker_edge"],
-        markeredgewidth=SEL_PRICE_STYLE["marker_edge_width"],
-        label=sel_label,
-    )
-    ax.plot(
-        years, cmp_prices,
-        color=CMP_PRICE_STYLE["line_color"],
-        linewidth=CMP_PRICE_STYLE["line_width"],
-        linestyle=CMP_PRICE_STYLE["line_style"],
-        marker=CMP_PRICE_STYLE["marker"],
-        markersize=CMP_PRICE_STYLE["marker_size"],
-        markerfacecolor=CMP_PRICE_STYLE["marker_face"],
-        markeredgecolor=CMP_PRICE_STYLE["marker_edge"],
-        markeredgewidth=CMP_PRICE_STYLE["marker_edge_width"],
-        label=cmp_label,
-    )
-
-    ax.set_title("2016 유사 가격 타구역 비교: 공시가격 추이")
-    ax.set_xlabel("연도")
-    ax.set_ylabel("공시가격(억)")
-
-    ax.set_xticks(years)
-    ax.set_xticklabels([str(y) for y in years], rotation=0)
-
-    # 마지막 연도만 볼드 라벨
-    last_year = years[-1]
-    sel_last = sel_prices[-1]
-    cmp_last = cmp_prices[-1]
-
-    spread = abs(sel_last - cmp_last)
-    sel_off = (0, 16)
-    cmp_off = (0, -26) if spread < 1.0 else (0, 16)
-
-    ax.annotate(
-        f"{sel_last:.2f}",
-        xy=(last_year, sel_last),
-        xytext=sel_off,
-        textcoords="offset points",
-        ha="center",
-        va="bottom" if sel_off[1] >= 0 else "top",
-        fontsize=11,
-        fontweight="bold",
-        bbox=dict(boxstyle="round,pad=0.18", facecolor="white", edgecolor="none", alpha=0.9),
-    )
-    ax.annotate(
-        f"{cmp_last:.2f}",
-        xy=(last_year, cmp_last),
-        xytext=cmp_off,
-        textcoords="offset points",
-        ha="center",
-        va="bottom" if cmp_off[1] >= 0 else "top",
-        fontsize=11,
-        fontweight="bold",
-        bbox=dict(boxstyle="round,pad=0.18", facecolor="white", edgecolor="none", alpha=0.9),
-    )
-
-    ax.grid(True, alpha=0.3)
-    leg = ax.legend(loc="best")
-    # 범례/축/제목 등 모든 텍스트에 얇은 검정 엣지 적용
-    for _t in [ax.title, ax.xaxis.label, ax.yaxis.label]:
-        _t.set_path_effects([pe.withStroke(linewidth=0.3, foreground="black")])
-    for _lab in (ax.get_xticklabels() + ax.get_yticklabels()):
-        _lab.set_path_effects([pe.withStroke(linewidth=0.3, foreground="black")])
-    if leg is not None:
-        for _lt in leg.get_texts():
-                            _lt.set_fontweight("normal")
-                            _lt.set_path_effects([pe.withStroke(linewidth=0.3, foreground="black")])
-    fig.tight_layout()
-    return fig
-
-def plot_price_compare_bars(
-    years: list[int],
-    sel_prices: list[float],
-    cmp_prices: list[float],
-    sel_label: str,
-    cmp_label: str,
-    title: str,
-):
-    """연도별 2개 시리즈(선택/비교)를 그룹 막대로 표시."""
-    import numpy as np
-
-    fig, ax = plt.subplots(figsize=(7.4, RANK_FIG_HEIGHT_IN), dpi=RANK_FIG_DPI)
-
-    x = np.arange(len(years))
-    width = 0.40
-
-    b1 = ax.bar(
-        x - width / 2,
-        sel_prices,
-        width,
-        label=sel_label,
-        color=SEL_BAR_STYLE["face_color"],
-        edgecolor=SEL_BAR_STYLE["edge_color"],
-        linewidth=SEL_BAR_STYLE["linewidth"],
-        alpha=SEL_BAR_STYLE["alpha"],
-        hatch=SEL_BAR_STYLE["hatch"],
-        zorder=3,
-    )
-    b2 = ax.bar(
-        x + width / 2,
-        cmp_prices,
-        width,
-        label=cmp_label,
-        color=CMP_BAR_STYLE["face_color"],
-        edgecolor=CMP_BAR_STYLE["edge_color"],
-        linewidth=CMP_BAR_STYLE["linewidth"],
-        alpha=CMP_BAR_STYLE["alpha"],
-        hatch=CMP_BAR_STYLE["hatch"],
-        zorder=3,
-    )
+        # RANK_LABEL_Y_OFFSET은 음수일수록 위쪽, Vega dy는 아래쪽이 + 이므로 부호를 반대로 적용
+        labels = base.mark_text(
+            dy=-RANK_LABEL_Y_OFFSET,
+            baseline="bottom",
+            fontSize=RANK_LABEL_FONTSIZE,
+            fontWeight="bold" if RANK_LABEL_BOLD else "normal",
+        ).encode(text=alt.Text("순위:Q", format="d"))
+        chart = chart + labels
 
-    ax.set_title(title)
-    ax.set_xlabel("연도")
-    ax.set_ylabel("공시가격(억)")
-    ax.set_xticks(x)
-    ax.set_xticklabels([str(y) for y in years], rotation=0)
-
-    # 값 라벨(과밀 방지를 위해 모든 연도에 작은 라벨 적용)
-    def _label_bars(bars, values):
-        for rect, v in zip(bars, values):
-            if v is None:
-                continue
-            ax.annotate(
-                f"{v:.2f}",
-                (rect.get_x() + rect.get_width() / 2, rect.get_height()),
-                textcoords="offset points",
-                xytext=(0, 6),
-                ha="center",
-                va="bottom",
-                fontsize=8,
-                fontweight="bold" if rect is bars[-1] else "normal",
-            )
+    return chart.properties(title=title, height=RANK_CHART_HEIGHT_PX).configure_axis(gridOpacity=0.3)
 
-    _label_bars(b1, sel_prices)
-    _label_bars(b2, cmp_prices)
 
-    ax.grid(True, axis="y", alpha=0.25, zorder=0)
-    ax.set_axisbelow(True)
-    ax.legend(loc="best", frameon=True, framealpha=0.9)
-    fig.tight_layout()
-    return fig
 # =========================
 # 메인
 # =========================
@@ -1273,157 +1682,29 @@ st.title("압구정 예비 권리가액 랭킹")
 st.caption(APP_DESCRIPTION)
 st.markdown(PROMO_TEXT_HTML, unsafe_allow_html=True)
 
-try:
-    df_raw = load_from_gsheet(MAIN_SPREADSHEET_ID, MAIN_GID, MAIN_WORKSHEET_NAME)
-except Exception as e:
-    st.error(f"구글시트 로딩 실패: {e}")
-    st.stop()
+# 시트를 수정한 직후 TTL(10분)을 기다리지 않고 바로 반영하고 싶을 때 사용
+if st.sidebar.button("데이터 새로고침", key="refresh_main_data"):
+    refresh_main_data()
 
 try:
-    df = _clean_main_df(df_raw)
+    main_data = load_main_dataset(MAIN_SPREADSHEET_ID, MAIN_GID, MAIN_WORKSHEET_NAME)
 except Exception as e:
-    st.error(f"데이터 정리 실패: {e}")
-    st.stop()
-
-year_cols_all = _detect_year_cols(df)
-df_num = _coerce_numeric(df, year_cols_all)
-year_cols = _filter_year_cols_with_data(df_num, year_cols_all)
-# 요청: 공시가격은 2016년부터 사용
-year_cols = [y for y in year_cols if int(y) >= 2016]
-if not year_cols:
-    st.error("연도 컬럼은 있으나 실제 데이터가 있는 연도가 없습니다.")
+    st.error(str(e))
     st.stop()
 
-zones = sorted(df_num["구역"].dropna().unique().tolist())
-
-
-
-def plot_price_rank_arrow(
-    base_p0: float, base_r0: float, base_p1: float, base_r1: float,
-    cmp_p0: float, cmp_r0: float, cmp_p1: float, cmp_r1: float,
-    last_year: str,
-    sel_label: str, cmp_label: str,
-):
-    """2016→최신연도 이동을 '가격(x) - 순위(y)' 공간에서 화살표로 표현.
-
-    라벨(연도/가격/순위) 박스가 겹치는 경우가 자주 발생하므로,
-    - 2016 라벨끼리, 2025 라벨끼리 각각 근접하면 서로 다른 오프셋을 자동 부여하여 겹침을 최소화합니다.
-    """
-    fig, ax = plt.subplots(figsize=(7.2, 4.8), dpi=RANK_FIG_DPI)
-    ax.invert_yaxis()  # 위로 갈수록 상위(작은 순위)
-
-    def _pt_label(year: str, price: float, rank: float) -> str:
-        return f"{year}\n{price:.2f}억\n{int(rank):,}위"
-
-    def _separate_offsets(p_a, r_a, p_b, r_b, default_a, default_b):
-        """두 점이 근접하면 라벨 오프셋을 다르게 주어 겹침을 피한다(포인트 단위)."""
-        close = (abs(p_a - p_b) < 2.0) and (abs(r_a - r_b) < 250.0)
-        if not close:
-            return default_a, default_b
-
-        # 더 상위(작은 순위)인 쪽 라벨을 위로, 다른 쪽은 아래로 크게 분리
-        if r_a <= r_b:
-            return (12, -66), (12, 18)
-        else:
-            return (12, 18), (12, -66)
-
-    # 기본 오프셋(겹치지 않으면 그대로 사용)
-    base0_off, cmp0_off = _separate_offsets(
-        base_p0, base_r0, cmp_p0, cmp_r0,
-        default_a=(12, -18),
-        default_b=(12, 18),
-    )
-    base1_off, cmp1_off = _separate_offsets(
-        base_p1, base_r1, cmp_p1, cmp_r1,
-        default_a=(12, -18),
-        default_b=(12, 18),
-    )
-
-    # 점/화살표(선택)
-    ax.scatter(
-        [base_p0, base_p1], [base_r0, base_r1],
-        s=110, marker='o',
-        c=SEL_BAR_STYLE['face_color'],
-        edgecolors=SEL_BAR_STYLE['edge_color'],
-        linewidths=SEL_BAR_STYLE['linewidth'],
-        zorder=3,
-        label=sel_label,
-    )
-    ax.annotate(
-        '', xy=(base_p1, base_r1), xytext=(base_p0, base_r0),
-        arrowprops=dict(arrowstyle='->', lw=2.6, color=SEL_BAR_STYLE['edge_color']),
-        zorder=2,
-    )
-
-    # 점/화살표(비교)
-    ax.scatter(
-        [cmp_p0, cmp_p1], [cmp_r0, cmp_r1],
-        s=110, marker='s',
-        c=CMP_BAR_STYLE['face_color'],
-        edgecolors=CMP_BAR_STYLE['edge_color'],
-        linewidths=CMP_BAR_STYLE['linewidth'],
-        zorder=3,
-        label=cmp_label,
-    )
-    ax.annotate(
-        '', xy=(cmp_p1, cmp_r1), xytext=(cmp_p0, cmp_r0),
-        arrowprops=dict(arrowstyle='->', lw=2.6, color=CMP_BAR_STYLE['edge_color']),
-        zorder=2,
-    )
+# df_num은 모든 세션이 공유하는 캐시 객체이므로 읽기 전용으로만 사용(제자리 수정 금지)
+df_num = main_data.df
+year_cols = main_data.year_cols
+# 연도 문자열 → 정수 변환/정렬은 재실행당 한 번만(3번 비교의 최신연도·레이싱차트 연도축에서 재사용)
+_years_arr = np.fromiter((int(y) for y in year_cols), dtype=np.int32, count=len(year_cols))
+_year_order = np.argsort(_years_arr, kind="stable")
+year_cols_sorted = [year_cols[i] for i in _year_order]
+years_int_sorted = tuple(_years_arr[_year_order].tolist())
+latest_year = str(years_int_sorted[-1])
+# 구역은 정리 단계에서 남은 값만, 정렬된 카테고리로 보관되므로 전체 행 unique/정렬 없이 그대로 사용
+zones = df_num["구역"].cat.categories.tolist()
 
-    # 라벨(연도/가격/순위) - 겹침 최소화 오프셋 적용
-    ax.annotate(
-        _pt_label("2016", base_p0, base_r0),
-        xy=(base_p0, base_r0),
-        xytext=base0_off,
-        textcoords="offset points",
-        fontsize=10,
-        fontweight="bold",
-        color=SEL_BAR_STYLE["edge_color"],
-        bbox=dict(boxstyle="round,pad=0.25", fc="white", ec=SEL_BAR_STYLE["edge_color"], alpha=0.78),
-        zorder=4,
-    )
-    ax.annotate(
-        _pt_label(str(last_year), base_p1, base_r1),
-        xy=(base_p1, base_r1),
-        xytext=base1_off,
-        textcoords="offset points",
-        fontsize=10,
-        fontweight="bold",
-        color=SEL_BAR_STYLE["edge_color"],
-        bbox=dict(boxstyle="round,pad=0.25", fc="white", ec=SEL_BAR_STYLE["edge_color"], alpha=0.78),
-        zorder=4,
-    )
-    ax.annotate(
-        _pt_label("2016", cmp_p0, cmp_r0),
-        xy=(cmp_p0, cmp_r0),
-        xytext=cmp0_off,
-        textcoords="offset points",
-        fontsize=10,
-        fontweight="bold",
-        color=CMP_BAR_STYLE["edge_color"],
-        bbox=dict(boxstyle="round,pad=0.25", fc="white", ec=CMP_BAR_STYLE["edge_color"], alpha=0.78),
-        zorder=4,
-    )
-    ax.annotate(
-        _pt_label(str(last_year), cmp_p1, cmp_r1),
-        xy=(cmp_p1, cmp_r1),
-        xytext=cmp1_off,
-        textcoords="offset points",
-        fontsize=10,
-        fontweight="bold",
-        color=CMP_BAR_STYLE["edge_color"],
-        bbox=dict(boxstyle="round,pad=0.25", fc="white", ec=CMP_BAR_STYLE["edge_color"], alpha=0.78),
-        zorder=4,
-    )
 
-    ax.set_title(f"가격-순위 이동(2016→{last_year})")
-    ax.set_xlabel("공시가격(억)")
-    ax.set_ylabel("압구정 전체 순위(위로 갈수록 상위)")
-    ax.grid(True, alpha=0.25)
-    ax.legend(loc='best')
-    fig.tight_layout()
-    return fig
 def reset_after_zone():
     st.session_state["dong_pair"] = None
     st.session_state["ho"] = None
@@ -1450,20 +1731,8 @@ if zone is None:
     dong_pairs = []
     _dong_is_unique = True
 else:
-    zone_df0 = df_num[df_num["구역"] == zone].copy()
-    dong_pairs = (
-        zone_df0[["단지명", "동"]]
-        .dropna()
-        .drop_duplicates()
-        .sort_values(["단지명", "동"])
-        .to_records(index=False)
-        .tolist()
-    )
-
-    # 같은 구역 내에서 '동' 값이 단지명과 1:1이면, 화면에는 '동'만 노출(요청사항: 구역/동/호)
-    # 만약 같은 '동'이 여러 단지에 존재하면 혼동 방지를 위해 단지명도 함께 표기합니다.
-    _dong_only_ok = (pd.Series([int(x[1]) for x in dong_pairs]).value_counts().max() == 1) if dong_pairs else True
-    _dong_is_unique = bool(_dong_only_ok)
+    # 구역별 동 목록/구분 여부는 로딩 시 한 번만 계산(재실행마다 구역 전체를 다시 정렬하지 않음)
+    dong_pairs, _dong_is_unique = zone_dong_meta(df_num, zone)
 
 
 def fmt_dong(x):
@@ -1486,14 +1755,7 @@ if zone is None or dong_pair is None:
     ho_list = []
 else:
     complex_name0, dong0 = dong_pair[0], int(dong_pair[1])
-    ho_list = (
-        df_num[(df_num["구역"] == zone) & (df_num["단지명"] == complex_name0) & (df_num["동"] == dong0)]["호"]
-        .dropna()
-        .drop_duplicates()
-        .sort_values()
-        .astype(int)
-        .tolist()
-    )
+    ho_list = dong_ho_list(df_num, zone, complex_name0, dong0)
 
 ho = st.selectbox("호 선택", ho_list, index=None, placeholder="호를 선택하세요",
                   key="ho", disabled=(dong_pair is None))
@@ -1516,6 +1778,9 @@ if confirmed_click:
         except Exception as e:
             st.warning(f"조회 로그 기록 실패(권한/시트 설정 확인 필요): {e}")
 
+# 백그라운드 기록 실패는 클릭 시점에 알 수 없으므로 이후 실행에서 알림
+notify_log_failures()
+
 if not st.session_state.get("confirmed", False):
     st.markdown('<div class="small-note">구역 → 동 → 호 선택 후, 확인을 누르면 결과가 표시됩니다.</div>',
                 unsafe_allow_html=True)
@@ -1527,7 +1792,7 @@ ho = int(st.session_state["ho"])
 
 
 try:
-    zone_table, all_table = compute_rank_tables(df_num, year_cols, zone, complex_name, dong, ho)
+    zone_table, all_table, z_plot, a_plot = compute_rank_tables(df_num, year_cols, zone, complex_name, dong, ho)
 except Exception as e:
     st.error(f"랭킹 산출 실패: {e}")
     st.stop()
@@ -1537,46 +1802,41 @@ except Exception as e:
 # 선택 요약 (요청: 한 줄 요약)
 # =========================
 # 선택 행
-pick = df_num[
-    (df_num["구역"] == zone)
-    & (df_num["단지명"] == complex_name)
-    & (df_num["동"] == dong)
-    & (df_num["호"] == ho)
-]
-pick_row = pick.iloc[0] if not pick.empty else None
+pick_pos = find_row_pos(df_num, zone, complex_name, dong, ho)
+pick_row = df_num.iloc[pick_pos] if pick_pos is not None else None
+
+# 요약 카드에 쓰는 부가 컬럼 별칭(시트마다 헤더 표기가 조금씩 달라 앞에서부터 먼저 있는 것을 사용)
+_COL_ALIASES = {
+    "area": ("전용면적(㎡)", "전용면적", "전용면적  (㎡).", "전용면적 (㎡)", "전용면적㎡"),
+    "land": ("대지지분(평)", "대지지분", "대지지분    (평)", "대지지분 (평)", "대지지분평"),
+    "note": ("특기사항", "특기 사항", "비고", "Remarks"),
+}
 
-def _find_first_col(df_: pd.DataFrame, candidates: list[str]) -> str | None:
-    cols = set(df_.columns)
-    for c in candidates:
-        if c in cols:
-            return c
-    return None
 
-area_col = _find_first_col(df_num, ["전용면적(㎡)", "전용면적", "전용면적  (㎡).", "전용면적 (㎡)", "전용면적㎡"])
-land_col = _find_first_col(df_num, ["대지지분(평)", "대지지분", "대지지분    (평)", "대지지분 (평)", "대지지분평"])
-note_col = _find_first_col(df_num, ["특기사항", "특기 사항", "비고", "Remarks"])
+@st.cache_data(show_spinner=False)
+def _resolve_cols(columns: tuple[str, ...]) -> dict[str, str | None]:
+    """_COL_ALIASES의 각 항목을 실제 컬럼명으로 한 번만 해석합니다(컬럼 튜플 기준 캐시)."""
+    cols = set(columns)
+    return {key: next((c for c in cands if c in cols), None) for key, cands in _COL_ALIASES.items()}
 
-def _fmt_num(v, fmt: str = "{:.2f}") -> str:
-    try:
-        if v is None or (isinstance(v, float) and pd.isna(v)) or pd.isna(v):
-            return "-"
-    except Exception:
-        pass
-    try:
-        return fmt.format(float(v))
-    except Exception:
-        return "-"
 
-# 2025 요약값
-_y = 2025
-price_2025 = zone_table.loc[zone_table["연도"] == _y, "공시가격(억)"]
-price_2025_v = price_2025.iloc[0] if len(price_2025) else pd.NA
+_resolved_cols = _resolve_cols(tuple(df_num.columns))
+area_col = _resolved_cols["area"]
+land_col = _resolved_cols["land"]
+note_col = _resolved_cols["note"]
 
-zone_rank_2025 = zone_table.loc[zone_table["연도"] == _y, "구역 내 랭킹"]
-zone_rank_2025_v = str(zone_rank_2025.iloc[0]) if len(zone_rank_2025) else "-"
+def _fmt_num(v, fmt: str = "{:.2f}") -> str:
+    # v != v 는 NaN 판별(pd.isna/try-except 없이 처리). None/pd.NA/문자열은 숫자 타입이 아니므로 "-"
+    if isinstance(v, (int, float, np.integer, np.floating)) and v == v:
+        return fmt.format(v)
+    return "-"
 
-all_rank_2025 = all_table.loc[all_table["연도"] == _y, "압구정 전체 랭킹"]
-all_rank_2025_v = str(all_rank_2025.iloc[0]) if len(all_rank_2025) else "-"
+# 2025 요약값: 요약 카드는 한 연도만 필요하므로 해당 연도만 계산
+_y = 2025
+_p, _zr, _ar, _zn, _an = _rank_for_years(df_num, [str(_y)], zone, complex_name, dong, ho)
+price_2025_v = _p[0]
+zone_rank_2025_v = _fmt_ranks(_zr, _zn)[0] or "-"
+all_rank_2025_v = _fmt_ranks(_ar, _an)[0] or "-"
 
 area_v = pd.to_numeric(pick_row[area_col], errors="coerce") if (pick_row is not None and area_col) else pd.NA
 land_v = pd.to_numeric(pick_row[land_col], errors="coerce") if (pick_row is not None and land_col) else pd.NA
@@ -1619,21 +1879,6 @@ st.divider()
 #   3행: 유사 타구역 비교 그래프 (전체 폭)
 # =========================
 
-# 랭킹 그래프용 데이터 준비
-z_plot = zone_table.copy()
-z_plot["rank"] = z_plot["구역 내 랭킹"].apply(_parse_rank_text)
-z_plot = z_plot.dropna(subset=["rank"]).copy()
-z_plot["연도"] = z_plot["연도"].astype(int)
-z_plot["rank"] = z_plot["rank"].astype(int)
-z_plot = z_plot.sort_values("연도")
-
-a_plot = all_table.copy()
-a_plot["rank"] = a_plot["압구정 전체 랭킹"].apply(_parse_rank_text)
-a_plot = a_plot.dropna(subset=["rank"]).copy()
-a_plot["연도"] = a_plot["연도"].astype(int)
-a_plot["rank"] = a_plot["rank"].astype(int)
-a_plot = a_plot.sort_values("연도")
-
 st.subheader("랭킹변화")
 
 # ---------- 1행 ----------
@@ -1647,13 +1892,13 @@ with r1:
     if z_plot.empty:
         st.info("구역 내 순위 그래프를 그릴 데이터가 없습니다.")
     else:
-        fig1 = plot_rank_line(
+        chart1 = rank_line_chart(
             years=z_plot["연도"].tolist(),
             ranks=z_plot["rank"].tolist(),
             title=f"{zone} / {dong}동 / {ho}호  (구역 내 순위)",
             style=ZONE_RANK_STYLE,
         )
-        st.pyplot(fig1, use_container_width=True)
+        st.altair_chart(chart1, use_container_width=True)
 
 # ---------- 2행 ----------
 l2, r2 = st.columns(2, gap="large")
@@ -1666,270 +1911,420 @@ with r2:
     if a_plot.empty:
         st.info("압구정 전체 순위 그래프를 그릴 데이터가 없습니다.")
     else:
-        fig2 = plot_rank_line(
+        chart2 = rank_line_chart(
             years=a_plot["연도"].tolist(),
             ranks=a_plot["rank"].tolist(),
             title=f"{zone} / {dong}동 / {ho}호  (압구정 전체 순위)",
             style=ALL_RANK_STYLE,
         )
-        st.pyplot(fig2, use_container_width=True)
+        st.altair_chart(chart2, use_container_width=True)
 
 st.divider()
 
-st.markdown("**3) 타구역 비교 (기준단지 1개 + 비교단지 2개 선택 → 비교하기)**")
 
-last_year = str(max(int(y) for y in year_cols))
+@st.cache_resource(ttl=600, show_spinner=False)
+def _complex_pyeong_index(df_key: str, pyeong_col: str, last_year: str):
+    """3번 비교용 조회 구조를 한 번만 만듭니다(공유 객체이므로 읽기 전용으로 사용).
 
-pyeong_col = detect_pyeong_col(df_num)
-if pyeong_col is None:
-    st.info("평형 컬럼(예: '평형' 또는 '평형(평)')이 없어 3번 비교 기능을 사용할 수 없습니다.")
-else:
-    # --- 공통: 전체 순위(2016/최신연도) 시리즈를 미리 계산 ---
-    if "2016" not in df_num.columns or last_year not in df_num.columns:
-        st.info("2016 또는 최신연도 컬럼이 없어 3번 비교 기능을 사용할 수 없습니다.")
-    else:
-        r2016_all = df_num["2016"].rank(method="min", ascending=False)
-        rlast_all = df_num[last_year].rank(method="min", ascending=False)
-
-        def _pyeong_sort_key(s: str):
-            # '56평' / '56.5평' / '56' 등 대응
-            import re
-            m = re.search(r"(\d+(?:\.\d+)?)", str(s))
-            return float(m.group(1)) if m else 999999.0
-
-        def _get_pyeong_options(_zone: str, _complex: str) -> list[str]:
-            sub = df_num[(df_num["구역"] == _zone) & (df_num["단지명"] == _complex)]
-            if sub.empty:
-                return []
-            vals = sub[pyeong_col].apply(_fmt_pyeong).dropna().astype(str).unique().tolist()
-            vals = [v for v in vals if str(v).strip() and str(v).strip().lower() != "nan"]
-            vals = sorted(set(vals), key=_pyeong_sort_key)
-            return vals
-
-        def _pick_representative(_zone: str, _complex: str, _pyeong_fmt: str):
-            """(구역/단지/평형) 중 최신연도 공시가격이 가장 높은 1개 동/호를 대표로 선택."""
-            sub = df_num[(df_num["구역"] == _zone) & (df_num["단지명"] == _complex)].copy()
-            if sub.empty:
-                return None
-
-            sub["_pyeong_fmt"] = sub[pyeong_col].apply(_fmt_pyeong)
-            sub = sub[sub["_pyeong_fmt"] == _pyeong_fmt].copy()
-            if sub.empty:
-                return None
-
-            # 대표 선택: 최신연도(last_year) 공시가격 최대 → 없으면 2016 최대 → 그래도 없으면 첫 행
-            p_last = pd.to_numeric(sub[last_year], errors="coerce")
-            if p_last.notna().any():
-                rep_idx = int(p_last.idxmax())
-            else:
-                p_2016 = pd.to_numeric(sub["2016"], errors="coerce")
-                rep_idx = int(p_2016.idxmax()) if p_2016.notna().any() else int(sub.index[0])
-
-            row = df_num.loc[rep_idx]
-            rep_dong = int(row["동"])
-            rep_ho = int(row["호"])
-            rep_pyeong_raw = row[pyeong_col]
-
-            p2016 = pd.to_numeric(row.get("2016", pd.NA), errors="coerce")
-            plast = pd.to_numeric(row.get(last_year, pd.NA), errors="coerce")
-            r2016 = r2016_all.loc[rep_idx]
-            rlast = rlast_all.loc[rep_idx]
-
-            return {
-                "idx": rep_idx,
-                "zone": _zone,
-                "complex": _complex,
-                "pyeong_raw": rep_pyeong_raw,
-                "pyeong_fmt": _pyeong_fmt,
-                "dong": rep_dong,
-                "ho": rep_ho,
-                "price_2016": float(p2016) if pd.notna(p2016) else None,
-                "price_last": float(plast) if pd.notna(plast) else None,
-                "rank_2016": int(r2016) if pd.notna(r2016) else None,
-                "rank_last": int(rlast) if pd.notna(rlast) else None,
-            }
-
-        def _unit_brief(u: dict) -> str:
-            floor = infer_floor_from_ho(u["ho"])
-            floor_txt = f"{floor}층" if floor is not None else "층?"
-            return f"{u['zone']} / {u['complex']} / {u['pyeong_fmt']} / {u['dong']}동 / {floor_txt}"
-
-        st.caption(
-            f"각 단지의 **선택한 평형**에서 **{last_year} 공시가격이 가장 높은 1개 동/호**를 대표로 자동 선택해 비교합니다."
+    반환: (groups, pyeong_fmt, pyeong_options, p2016, plast)
+      - groups[(구역, 단지명)]: 해당 단지 행 위치(iloc) 배열
+      - pyeong_fmt: 행별 _fmt_pyeong 결과(고유값만 한 번씩 변환)
+      - pyeong_options[(구역, 단지명)]: 평형 선택 목록(숫자 크기순)
+      - p2016 / plast: 2016 / 최신연도 공시가격 배열
+    """
+    df_num = _df_num_registry()[df_key]
+    groups = {
+        (str(z), str(c)): pos
+        for (z, c), pos in df_num.groupby(["구역", "단지명"], observed=True, sort=False).indices.items()
+    }
+    codes, uniq = pd.factorize(df_num[pyeong_col], use_na_sentinel=False)
+    fmt_uniq = [_fmt_pyeong(v) for v in uniq]
+    pyeong_fmt = np.array(fmt_uniq, dtype=object)[codes]
+
+    # 정렬 키는 표시값마다 한 번만 계산(목록은 여기서 한 번 정렬해 두고 재실행 때는 다시 정렬하지 않음)
+    sort_key = {v: _pyeong_sort_key(v) for v in set(fmt_uniq)}
+    pyeong_options = {}
+    for k, pos in groups.items():
+        vals = {fmt_uniq[c] for c in np.unique(codes[pos])}
+        vals = [v for v in vals if v.strip() and v.strip().lower() != "nan"]
+        pyeong_options[k] = sorted(vals, key=sort_key.__getitem__)
+
+    p2016 = df_num["2016"].to_numpy(dtype=np.float32, na_value=np.nan)
+    plast = df_num[last_year].to_numpy(dtype=np.float32, na_value=np.nan)
+    return groups, pyeong_fmt, pyeong_options, p2016, plast
+
+
+@st.cache_resource(ttl=600, show_spinner=False)
+def _zone_complexes(df_key: str) -> dict[str, list[str]]:
+    """구역 → 정렬된 단지명 목록(3번 비교의 단지 선택 목록, 읽기 전용)."""
+    df_num = _df_num_registry()[df_key]
+    return {
+        str(z): sorted(g.dropna().unique().tolist())
+        for z, g in df_num.groupby("구역", observed=True, sort=False)["단지명"]
+    }
+
+
+@st.cache_resource(max_entries=64, show_spinner=False)
+def race_chart_figure(
+    rank_rows: tuple[tuple[float, ...], ...],
+    years_int: tuple[int, ...],
+    cat_display: tuple[str, ...],
+    colors: tuple[str, ...],
+    total_n: int,
+    is_mobile: bool,
+):
+    """3개 단지 연도별 순위 경쟁(Bar Chart Race) Plotly Figure.
+
+    rank_rows는 (연도 수, 3) 순위(열 순서 = cat_display: 화면 위→아래), 순위가 없으면 NaN.
+    같은 선택·기기 유형이면 트레이스/프레임을 다시 만들지 않고 캐시된 Figure를 재사용합니다(공유 객체이므로 수정 금지).
+    """
+    import plotly.graph_objects as go
+
+    # y축 카테고리 순서를 고정(막대 위치가 연도에 따라 위아래로 바뀌지 않도록)
+    cat_order = list(cat_display[::-1])      # Plotly는 (아래→위)로 카테고리를 쌓으므로 역순 사용
+    cat_colors = list(colors[::-1])
+
+    # (연도 수, 3) 행렬을 cat_order 열 순서로 한 번 뒤집고 점수도 한 번에 계산(프레임마다 필터링 없음)
+    race_rank = np.array(rank_rows, dtype=np.float64)[:, ::-1]
+    race_valid = ~np.isnan(race_rank)
+    race_score = np.where(race_valid, total_n - race_rank + 1.0, 0.0)  # 상위일수록 큰 값
+    score_max = float(race_score[race_valid].max())
+
+    def _bar_for_year(i: int):
+        # 카테고리(막대 위치) 고정: 연도별로 순위가 바뀌어도 위/아래 위치가 변하지 않음
+        bar = go.Bar(
+            x=race_score[i],
+            y=cat_order,
+            orientation="h",
+            marker=dict(color=cat_colors),
+            text=[f"{int(r):,}위" if ok else "" for r, ok in zip(race_rank[i], race_valid[i])],
+            textposition="outside",
+            textfont=dict(size=14, family="Arial Black"),
+            cliponaxis=False,
         )
+        return bar
+
+    frames = [go.Frame(data=[_bar_for_year(i)], name=str(yy)) for i, yy in enumerate(years_int)]
+
+    start_year, end_year = years_int[0], years_int[-1]
+    race_title = f"{start_year} → {end_year} 연도별 압구정 전체 순위 경쟁 (3개 단지)"
+    if is_mobile:
+        race_title = f"{start_year}→{end_year} 순위 경쟁 (3개 단지)"
+
+    xaxis_title = "상위 점수" if is_mobile else "상위 점수(높을수록 상위)"
+    race_height = 420 if is_mobile else 560
+    race_margin = dict(l=120, r=40, t=120, b=110) if is_mobile else dict(l=190, r=90, t=200, b=145)
+    y_tickfont = dict(size=13, family="Arial Black") if is_mobile else dict(size=15, family="Arial Black")
+    slider_y = -0.18 if is_mobile else -0.22
+    buttons_y = 1.08 if is_mobile else 1.14
+    title_y = 0.96 if is_mobile else 0.98
+    return go.Figure(
+        data=[_bar_for_year(0)],
+        layout=go.Layout(
+            title=dict(text=race_title, x=0.0, xanchor="left", y=title_y, yanchor="top"),
+            xaxis=dict(title=xaxis_title, range=[0, max(score_max, 1.0) * 1.12], tickfont=dict(size=12), titlefont=dict(size=13)),
+            yaxis=dict(title="", automargin=True, categoryorder="array", categoryarray=cat_order, tickfont=y_tickfont),
+            margin=race_margin,
+            height=race_height,
+            font=dict(size=12, family="Malgun Gothic"),
+            updatemenus=[
+                dict(
+                    type="buttons",
+                    direction="left",
+                    x=0.01, y=buttons_y, xanchor="left", yanchor="bottom",
+                    buttons=[
+                        dict(
+                            label="Play",
+                            method="animate",
+                            args=[None, {"frame": {"duration": 700, "redraw": True},
+                                         "transition": {"duration": 200},
+                                         "fromcurrent": True}],
+                        ),
+                        dict(
+                            label="Pause",
+                            method="animate",
+                            args=[[None], {"frame": {"duration": 0, "redraw": False},
+                                           "mode": "immediate"}],
+                        ),
+                    ],
+                )
+            ],
+            sliders=[
+                dict(
+                    x=0.01, y=slider_y, len=0.98,
+                    currentvalue=dict(prefix="연도: ", font=dict(size=14, family="Arial Black")),
+                    steps=[
+                        dict(
+                            method="animate",
+                            args=[[str(yy)], {"frame": {"duration": 0, "redraw": True},
+                                              "mode": "immediate"}],
+                            label=str(yy),
+                        )
+                        for yy in years_int
+                    ],
+                )
+            ],
+        ),
+        frames=frames,
+    )
 
-        # =========================
-        # 1) 기준단지 선택
-        # =========================
-        c1, c2, c3 = st.columns(3, gap="small")
 
-        # 기본값: 상단(구역/동/호 선택)에서 이미 선택된 값이 있으면 그걸 우선 사용
-        try:
-            default_base_zone = zone if zone in zones else zones[0]
-        except Exception:
-            default_base_zone = zones[0]
-
-        with c1:
-            base_zone = st.selectbox(
-                "기준단지 구역",
-                zones,
-                index=(zones.index(default_base_zone) if default_base_zone in zones else 0),
-                key="cmp3_base_zone",
-            )
+@st.fragment
+def render_compare_section(zone: str, complex_name: str, dong: int, ho: int) -> None:
+    """3) 타구역 비교. 이 구역의 위젯을 바꾸면 이 함수만 다시 실행됩니다(상단 선택/랭킹 표는 재실행하지 않음)."""
+    st.markdown("**3) 타구역 비교 (기준단지 1개 + 비교단지 2개 선택 → 비교하기)**")
+
+    last_year = latest_year
 
-        base_complex_list = sorted(df_num[df_num["구역"] == base_zone]["단지명"].dropna().unique().tolist())
-        if not base_complex_list:
-            st.info("기준단지 구역에 단지 데이터가 없습니다.")
-            base_complex = None
+    pyeong_col = detect_pyeong_col(df_num)
+    if pyeong_col is None:
+        st.info("평형 컬럼(예: '평형' 또는 '평형(평)')이 없어 3번 비교 기능을 사용할 수 없습니다.")
+    else:
+        # --- 공통: 전체 순위(2016/최신연도) 시리즈를 미리 계산 ---
+        if "2016" not in df_num.columns or last_year not in df_num.columns:
+            st.info("2016 또는 최신연도 컬럼이 없어 3번 비교 기능을 사용할 수 없습니다.")
         else:
+            # 연도별 전체 순위는 로더가 만든 배열(df_num 행 위치 기준)을 그대로 사용(재실행마다 rank 재계산 없음)
+            rank_mat, rank_year_row = rank_matrix(df_num)
+            r2016_all = rank_mat[rank_year_row["2016"]]
+            rlast_all = rank_mat[rank_year_row[last_year]]
+            cmp_df_key = register_df_num(df_num)
+            cmp_groups, cmp_pyeong_fmt, cmp_pyeong_options, cmp_p2016, cmp_plast = _complex_pyeong_index(
+                cmp_df_key, pyeong_col, last_year
+            )
+            cmp_zone_complexes = _zone_complexes(cmp_df_key)
+
+            def _complex_list(_zone: str) -> list[str]:
+                return list(cmp_zone_complexes.get(str(_zone), ()))
+
+            def _get_pyeong_options(_zone: str, _complex: str) -> list[str]:
+                return list(cmp_pyeong_options.get((str(_zone), str(_complex)), ()))
+
+            def _pick_representative(_zone: str, _complex: str, _pyeong_fmt: str):
+                """(구역/단지/평형) 중 최신연도 공시가격이 가장 높은 1개 동/호를 대표로 선택."""
+                pos = cmp_groups.get((str(_zone), str(_complex)))
+                if pos is None:
+                    return None
+                pos = pos[cmp_pyeong_fmt[pos] == _pyeong_fmt]
+                if len(pos) == 0:
+                    return None
+
+                # 대표 선택: 최신연도(last_year) 공시가격 최대 → 없으면 2016 최대 → 그래도 없으면 첫 행
+                # (float32 배열에서 바로 nanargmax: 동률이면 idxmax와 같이 첫 행, 2016 배열은 필요할 때만 슬라이스)
+                rep_pos = int(pos[0])
+                for prices in (cmp_plast, cmp_p2016):
+                    local = prices[pos]
+                    if np.isfinite(local).any():
+                        rep_pos = int(pos[np.nanargmax(local)])
+                        break
+
+                # 행 전체(Series)를 만들지 않고 필요한 값만 열/배열에서 직접 읽음(v != v 는 NaN)
+                p2016 = float(cmp_p2016[rep_pos])
+                plast = float(cmp_plast[rep_pos])
+                r2016 = float(r2016_all[rep_pos])
+                rlast = float(rlast_all[rep_pos])
+
+                return {
+                    "idx": df_num.index[rep_pos],
+                    "pos": rep_pos,
+                    "zone": _zone,
+                    "complex": _complex,
+                    "pyeong_raw": df_num[pyeong_col].iat[rep_pos],
+                    "pyeong_fmt": _pyeong_fmt,
+                    "dong": int(df_num["동"].iat[rep_pos]),
+                    "ho": int(df_num["호"].iat[rep_pos]),
+                    "price_2016": p2016 if p2016 == p2016 else None,
+                    "price_last": plast if plast == plast else None,
+                    "rank_2016": int(r2016) if r2016 == r2016 else None,
+                    "rank_last": int(rlast) if rlast == rlast else None,
+                }
+
+            def _unit_brief(u: dict) -> str:
+                floor = infer_floor_from_ho(u["ho"])
+                floor_txt = f"{floor}층" if floor is not None else "층?"
+                return f"{u['zone']} / {u['complex']} / {u['pyeong_fmt']} / {u['dong']}동 / {floor_txt}"
+
+            st.caption(
+                f"각 단지의 **선택한 평형**에서 **{last_year} 공시가격이 가장 높은 1개 동/호**를 대표로 자동 선택해 비교합니다."
+            )
+
+            # =========================
+            # 1) 기준단지 선택
+            # =========================
+            c1, c2, c3 = st.columns(3, gap="small")
+
+            # 기본값: 상단(구역/동/호 선택)에서 이미 선택된 값이 있으면 그걸 우선 사용
             try:
-                default_base_complex = complex_name if (base_zone == zone and complex_name in base_complex_list) else base_complex_list[0]
+                default_base_zone = zone if zone in zones else zones[0]
             except Exception:
-                default_base_complex = base_complex_list[0]
-
-            with c2:
-                base_complex = st.selectbox(
-                    "기준단지 단지명",
-                    base_complex_list,
-                    index=base_complex_list.index(default_base_complex) if default_base_complex in base_complex_list else 0,
-                    key="cmp3_base_complex",
+                default_base_zone = zones[0]
+
+            with c1:
+                base_zone = st.selectbox(
+                    "기준단지 구역",
+                    zones,
+                    index=(zones.index(default_base_zone) if default_base_zone in zones else 0),
+                    key="cmp3_base_zone",
                 )
 
-        base_pyeong = None
-        if base_complex:
-            base_pyeong_list = _get_pyeong_options(base_zone, base_complex)
-            if not base_pyeong_list:
-                st.info("기준단지에서 평형 후보를 찾지 못했습니다.")
+            base_complex_list = _complex_list(base_zone)
+            if not base_complex_list:
+                st.info("기준단지 구역에 단지 데이터가 없습니다.")
+                base_complex = None
             else:
-                # 상단 선택(구역/동/호)의 평형이 있으면 그걸 기본값으로
-                default_p = None
-                if base_zone == zone and base_complex == complex_name:
-                    sel_p = get_pyeong_value(df_num, zone, complex_name, dong, ho)
-                    if sel_p is not None and not pd.isna(sel_p):
-                        default_p = _fmt_pyeong(sel_p)
-                if default_p not in base_pyeong_list:
-                    default_p = base_pyeong_list[0]
-
-                with c3:
-                    base_pyeong = st.selectbox(
-                        "기준단지 평형",
-                        base_pyeong_list,
-                        index=base_pyeong_list.index(default_p) if default_p in base_pyeong_list else 0,
-                        key="cmp3_base_pyeong",
+                try:
+                    default_base_complex = complex_name if (base_zone == zone and complex_name in base_complex_list) else base_complex_list[0]
+                except Exception:
+                    default_base_complex = base_complex_list[0]
+
+                with c2:
+                    base_complex = st.selectbox(
+                        "기준단지 단지명",
+                        base_complex_list,
+                        index=base_complex_list.index(default_base_complex) if default_base_complex in base_complex_list else 0,
+                        key="cmp3_base_complex",
                     )
 
-        base_rep = _pick_representative(base_zone, base_complex, base_pyeong) if (base_complex and base_pyeong) else None
-        if base_rep:
-            st.markdown(f"- **기준단지(대표):** {_unit_brief(base_rep)}")
-
-        st.divider()
-
-        # =========================
-        # 2) 비교단지 1/2 선택
-        # =========================
-        def _default_other_zone(exclude: str) -> str:
-            for z in zones:
-                if z != exclude:
-                    return z
-            return exclude
-
-        d1, d2 = st.columns(2, gap="large")
-
-        with d1:
-            st.markdown("**비교단지 1**")
-            z1 = st.selectbox("구역", zones, index=zones.index(_default_other_zone(base_zone)) if zones else 0, key="cmp3_z1")
-            cplx1_list = sorted(df_num[df_num["구역"] == z1]["단지명"].dropna().unique().tolist())
-            cplx1 = st.selectbox("단지명", cplx1_list, key="cmp3_c1") if cplx1_list else None
-            p1_list = _get_pyeong_options(z1, cplx1) if cplx1 else []
-            p1 = st.selectbox("평형", p1_list, key="cmp3_p1") if p1_list else None
-            rep1 = _pick_representative(z1, cplx1, p1) if (cplx1 and p1) else None
-            if rep1:
-                st.markdown(f"- 대표: {_unit_brief(rep1)}")
-
-        with d2:
-            st.markdown("**비교단지 2**")
-            z2 = st.selectbox("구역", zones, index=zones.index(_default_other_zone(z1)) if zones else 0, key="cmp3_z2")
-            cplx2_list = sorted(df_num[df_num["구역"] == z2]["단지명"].dropna().unique().tolist())
-            cplx2 = st.selectbox("단지명", cplx2_list, key="cmp3_c2") if cplx2_list else None
-            p2_list = _get_pyeong_options(z2, cplx2) if cplx2 else []
-            p2 = st.selectbox("평형", p2_list, key="cmp3_p2") if p2_list else None
-            rep2 = _pick_representative(z2, cplx2, p2) if (cplx2 and p2) else None
-            if rep2:
-                st.markdown(f"- 대표: {_unit_brief(rep2)}")
-
-        st.divider()
-
-        # =========================
-        # 3) 비교하기 버튼 → 화살표 그래프 출력
-        # =========================
-        can_compare = base_rep is not None and rep1 is not None and rep2 is not None
-        if st.button("비교하기", key="cmp3_do_compare", type="secondary", disabled=not can_compare):
-            def _has_required(u: dict) -> bool:
-                return (
-                    u is not None
-                    and u.get("price_2016") is not None
-                    and u.get("price_last") is not None
-                    and u.get("rank_2016") is not None
-                    and u.get("rank_last") is not None
-                )
+            base_pyeong = None
+            if base_complex:
+                base_pyeong_list = _get_pyeong_options(base_zone, base_complex)
+                if not base_pyeong_list:
+                    st.info("기준단지에서 평형 후보를 찾지 못했습니다.")
+                else:
+                    # 상단 선택(구역/동/호)의 평형이 있으면 그걸 기본값으로
+                    default_p = None
+                    if base_zone == zone and base_complex == complex_name:
+                        sel_p = get_pyeong_value(df_num, zone, complex_name, dong, ho)
+                        if sel_p is not None and not pd.isna(sel_p):
+                            default_p = _fmt_pyeong(sel_p)
+                    if default_p not in base_pyeong_list:
+                        default_p = base_pyeong_list[0]
+
+                    with c3:
+                        base_pyeong = st.selectbox(
+                            "기준단지 평형",
+                            base_pyeong_list,
+                            index=base_pyeong_list.index(default_p) if default_p in base_pyeong_list else 0,
+                            key="cmp3_base_pyeong",
+                        )
+
+            base_rep = _pick_representative(base_zone, base_complex, base_pyeong) if (base_complex and base_pyeong) else None
+            if base_rep:
+                st.markdown(f"- **기준단지(대표):** {_unit_brief(base_rep)}")
+
+            st.divider()
+
+            # =========================
+            # 2) 비교단지 1/2 선택
+            # =========================
+            def _default_other_zone(exclude: str) -> str:
+                for z in zones:
+                    if z != exclude:
+                        return z
+                return exclude
+
+            d1, d2 = st.columns(2, gap="large")
+
+            with d1:
+                st.markdown("**비교단지 1**")
+                z1 = st.selectbox("구역", zones, index=zones.index(_default_other_zone(base_zone)) if zones else 0, key="cmp3_z1")
+                cplx1_list = _complex_list(z1)
+                cplx1 = st.selectbox("단지명", cplx1_list, key="cmp3_c1") if cplx1_list else None
+                p1_list = _get_pyeong_options(z1, cplx1) if cplx1 else []
+                p1 = st.selectbox("평형", p1_list, key="cmp3_p1") if p1_list else None
+                rep1 = _pick_representative(z1, cplx1, p1) if (cplx1 and p1) else None
+                if rep1:
+                    st.markdown(f"- 대표: {_unit_brief(rep1)}")
+
+            with d2:
+                st.markdown("**비교단지 2**")
+                z2 = st.selectbox("구역", zones, index=zones.index(_default_other_zone(z1)) if zones else 0, key="cmp3_z2")
+                cplx2_list = _complex_list(z2)
+                cplx2 = st.selectbox("단지명", cplx2_list, key="cmp3_c2") if cplx2_list else None
+                p2_list = _get_pyeong_options(z2, cplx2) if cplx2 else []
+                p2 = st.selectbox("평형", p2_list, key="cmp3_p2") if p2_list else None
+                rep2 = _pick_representative(z2, cplx2, p2) if (cplx2 and p2) else None
+                if rep2:
+                    st.markdown(f"- 대표: {_unit_brief(rep2)}")
+
+            st.divider()
+
+            # =========================
+            # 3) 비교하기 버튼 → 화살표 그래프 출력
+            # =========================
+            can_compare = base_rep is not None and rep1 is not None and rep2 is not None
+            # 버튼을 누른 시점의 대표 3개(행 위치)를 기억해, 선택이 그대로인 동안의 재실행(그래프 옵션 변경 등)에서도
+            # 결과를 유지합니다. 선택이 바뀌면 키가 달라져 다시 '비교하기'를 눌러야 계산합니다.
+            cmp_sel = (base_rep["pos"], rep1["pos"], rep2["pos"]) if can_compare else None
+            if st.button("비교하기", key="cmp3_do_compare", type="secondary", disabled=not can_compare):
+                st.session_state["cmp3_ready"] = cmp_sel
+            if cmp_sel is not None and st.session_state.get("cmp3_ready") == cmp_sel:
+                def _has_required(u: dict) -> bool:
+                    return (
+                        u is not None
+                        and u.get("price_2016") is not None
+                        and u.get("price_last") is not None
+                        and u.get("rank_2016") is not None
+                        and u.get("rank_last") is not None
+                    )
 
-            if not _has_required(base_rep):
-                st.warning("기준단지에 2016/최신연도 데이터가 부족합니다.")
-            elif not _has_required(rep1):
-                st.warning("비교단지 1에 2016/최신연도 데이터가 부족합니다.")
-            elif not _has_required(rep2):
-                st.warning("비교단지 2에 2016/최신연도 데이터가 부족합니다.")
-            else:
-                # --- 요약 표는 기존 렌더 함수 재사용(탭으로 분리) ---
-                
-                # --- 요약 표: 3개 단지를 한 번에 표시(탭 제거) ---
-                def _compact_colname(u: dict) -> str:
-                    # 예: "현대1,2차 54평"
-                    return f"{u['complex']} {u['pyeong_fmt']}".strip()
-
-                y0 = 2016
-                y1 = int(last_year)
-
-                base_nm = _compact_colname(base_rep)
-                c1_nm = _compact_colname(rep1)
-                c2_nm = _compact_colname(rep2)
-
-                # 상단 요약(짧은 표기)
-                st.markdown(
-                    f"<div style='text-align:center; font-weight:700; margin:4px 0 10px 0;'>"
-                    f"단지: {base_nm} &nbsp;&nbsp;|&nbsp;&nbsp; {c1_nm} &nbsp;&nbsp;|&nbsp;&nbsp; {c2_nm}"
-                    f"</div>",
-                    unsafe_allow_html=True,
-                )
+                if not _has_required(base_rep):
+                    st.warning("기준단지에 2016/최신연도 데이터가 부족합니다.")
+                elif not _has_required(rep1):
+                    st.warning("비교단지 1에 2016/최신연도 데이터가 부족합니다.")
+                elif not _has_required(rep2):
+                    st.warning("비교단지 2에 2016/최신연도 데이터가 부족합니다.")
+                else:
+                    # --- 요약 표는 기존 렌더 함수 재사용(탭으로 분리) ---
+
+                    # --- 요약 표: 3개 단지를 한 번에 표시(탭 제거) ---
+                    def _compact_colname(u: dict) -> str:
+                        # 예: "현대1,2차 54평"
+                        return f"{u['complex']} {u['pyeong_fmt']}".strip()
+
+                    y0 = 2016
+                    y1 = int(last_year)
+
+                    base_nm = _compact_colname(base_rep)
+                    c1_nm = _compact_colname(rep1)
+                    c2_nm = _compact_colname(rep2)
+
+                    # 상단 요약(짧은 표기)
+                    st.markdown(
+                        f"<div style='text-align:center; font-weight:700; margin:4px 0 10px 0;'>"
+                        f"단지: {base_nm} &nbsp;&nbsp;|&nbsp;&nbsp; {c1_nm} &nbsp;&nbsp;|&nbsp;&nbsp; {c2_nm}"
+                        f"</div>",
+                        unsafe_allow_html=True,
+                    )
 
-                def _f_price(v) -> str:
-                    try:
-                        return f"{float(v):.2f}"
-                    except Exception:
-                        return "-"
-                def _f_rank(v) -> str:
-                    try:
-                        return f"{int(v):,}"
-                    except Exception:
-                        return "-"
-
-                # 2행 헤더(단지명/평형만 상단에 노출)
-                rows_tbl = [
-                    (
-                        y0,
-                        _f_price(base_rep["price_2016"]), _f_rank(base_rep["rank_2016"]),
-                        _f_price(rep1["price_2016"]), _f_rank(rep1["rank_2016"]),
-                        _f_price(rep2["price_2016"]), _f_rank(rep2["rank_2016"]),
-                    ),
-                    (
-                        y1,
-                        _f_price(base_rep["price_last"]), _f_rank(base_rep["rank_last"]),
-                        _f_price(rep1["price_last"]), _f_rank(rep1["rank_last"]),
-                        _f_price(rep2["price_last"]), _f_rank(rep2["rank_last"]),
-                    ),
-                ]
-
-                html = f"""
+                    def _f_price(v) -> str:
+                        try:
+                            return f"{float(v):.2f}"
+                        except Exception:
+                            return "-"
+                    def _f_rank(v) -> str:
+                        try:
+                            return f"{int(v):,}"
+                        except Exception:
+                            return "-"
+
+                    # 2행 헤더(단지명/평형만 상단에 노출)
+                    rows_tbl = [
+                        (
+                            y0,
+                            _f_price(base_rep["price_2016"]), _f_rank(base_rep["rank_2016"]),
+                            _f_price(rep1["price_2016"]), _f_rank(rep1["rank_2016"]),
+                            _f_price(rep2["price_2016"]), _f_rank(rep2["rank_2016"]),
+                        ),
+                        (
+                            y1,
+                            _f_price(base_rep["price_last"]), _f_rank(base_rep["rank_last"]),
+                            _f_price(rep1["price_last"]), _f_rank(rep1["rank_last"]),
+                            _f_price(rep2["price_last"]), _f_rank(rep2["rank_last"]),
+                        ),
+                    ]
+
+                    html = f"""
                 <div class="summary-wrap">
                   <table class="summary-table">
                     <thead>
@@ -1947,220 +2342,86 @@ else:
                     </thead>
                     <tbody>
                 """
-                for (yy, bp, br, c1p, c1r, c2p, c2r) in rows_tbl:
-                    html += (
-                        f"<tr>"
-                        f"<th>{yy}</th>"
-                        f"<td>{bp}</td><td>{br}</td>"
-                        f"<td>{c1p}</td><td>{c1r}</td>"
-                        f"<td>{c2p}</td><td>{c2r}</td>"
-                        f"</tr>"
+                    for (yy, bp, br, c1p, c1r, c2p, c2r) in rows_tbl:
+                        html += (
+                            f"<tr>"
+                            f"<th>{yy}</th>"
+                            f"<td>{bp}</td><td>{br}</td>"
+                            f"<td>{c1p}</td><td>{c1r}</td>"
+                            f"<td>{c2p}</td><td>{c2r}</td>"
+                            f"</tr>"
+                        )
+                    html += """</tbody></table></div>"""
+
+                    st.markdown(html, unsafe_allow_html=True)
+    # --- 3개 단지를 하나의 화살표 그래프로 표현 ---
+                    # 요청 색상(기준/비교1/비교2)
+                    COLORS = ["#FF7DB0", "#00CAFF", "#B6F500"]
+
+                    # 연도 정렬(전체 연도 표시): year_cols_sorted / years_int_sorted는 데이터 로딩 직후 한 번 계산
+                    # 3개 단지 연도별 전체 순위(공시가격 내림차순): (연도 수, 3) 행렬(열 순서: 기준/비교1/비교2)
+                    # 로딩 때 전체 연도를 한 번에 순위화한 (연도, 행) 행렬에서 한 번의 인덱싱으로 꺼냅니다.
+                    unit_pos = np.array([base_rep["pos"], rep1["pos"], rep2["pos"]], dtype=np.intp)
+                    year_rows = np.array([rank_year_row[y] for y in year_cols_sorted], dtype=np.intp)
+                    rank_sub = rank_mat[np.ix_(year_rows, unit_pos)].astype(np.float64)
+
+                    graph_mode = st.radio(
+                        "하단 비교 그래프",
+                        ["레이싱차트(연도별 순위 경쟁)"],
+                        index=0,
+                        horizontal=True,
+                        key="cmp3_rank_graph_mode",
                     )
-                html += """</tbody></table></div>"""
-
-                st.markdown(html, unsafe_allow_html=True)
-# --- 3개 단지를 하나의 화살표 그래프로 표현 ---
-                import matplotlib.pyplot as plt
-
-                # 요청 색상(기준/비교1/비교2)
-                COLORS = ["#FF7DB0", "#00CAFF", "#B6F500"]
-
-                fig, ax = plt.subplots()
-
-                # 레전드 라벨은 길이를 줄여(모바일/데스크탑 공통) 단지명+평형만 표시
-                base_leg = base_nm
-                cmp1_leg = c1_nm
-                cmp2_leg = c2_nm# 연도 정렬(전체 연도 표시)
-                year_cols_sorted = sorted(year_cols, key=lambda s: int(s))
-                start_year = str(year_cols_sorted[0])
-                end_year = str(year_cols_sorted[-1])
-
-                # 연도별 전체 순위(공시가격 내림차순)
-                ranks_by_year = {y: df_num[y].rank(method="min", ascending=False) for y in year_cols_sorted}
-
-                units = [
-                    (base_leg, int(base_rep["idx"]), COLORS[0]),
-                    (cmp1_leg, int(rep1["idx"]), COLORS[1]),
-                    (cmp2_leg, int(rep2["idx"]), COLORS[2]),
-                ]
-
-                # 3개 단지 연도별 순위 시계열 데이터: x=연도, y=압구정 전체 순위
-                unit_series = []  # (label, years[int], ranks[float], color)
-                all_years = []
-                all_ranks = []
-
-                for label, ridx, color in units:
-                    yrs = []
-                    rs = []
-                    for y in year_cols_sorted:
-                        rser = ranks_by_year.get(y)
-                        if rser is None:
-                            continue
-                        rval = pd.to_numeric(rser.at[ridx], errors="coerce")
-                        if pd.notna(rval):
-                            yy = int(y)
-                            yrs.append(yy)
-                            rs.append(float(rval))
-                            all_years.append(yy)
-                            all_ranks.append(float(rval))
-                    unit_series.append((label, yrs, rs, color))
-
-                graph_mode = st.radio(
-                    "하단 비교 그래프",
-                    ["레이싱차트(연도별 순위 경쟁)"],
-                    index=0,
-                    horizontal=True,
-                    key="cmp3_rank_graph_mode",
-                )
 
-                if not all_years or not all_ranks:
-                    st.warning("선택된 단지들에서 연도별 '압구정 전체 순위' 데이터를 찾지 못했습니다.")
-                
-                else:
-                    # 그래프: 레이싱차트(연도별 순위 경쟁)
-                    if str(graph_mode).startswith("레이싱"):
-                        try:
-                            import plotly.graph_objects as go
-                        except Exception:
-                            st.warning("레이싱차트를 위해 plotly가 필요합니다. requirements.txt에 'plotly'를 추가해 주세요.")
-                            st.stop()  # plotly 미설치 시 레이싱차트를 렌더링할 수 없음
-
-                    if str(graph_mode).startswith("레이싱"):
-                        # -----------------------
-                        # Bar Chart Race (연도별 순위 경쟁)
-                        # -----------------------
-                        total_n = int(len(df_num))
-
-                        def _short_label(u: dict) -> str:
-                            return f"{u.get('complex','')} {u.get('pyeong_fmt','')}".strip()
-
-                        base_lbl = _short_label(base_rep)
-                        c1_lbl = _short_label(rep1)
-                        c2_lbl = _short_label(rep2)
-
-                        # 라벨이 비어있거나 중복되면 최소한의 구분자를 붙입니다.
-                        labels = [base_lbl or "기준", c1_lbl or "비교1", c2_lbl or "비교2"]
-                        seen = {}
-                        uniq = []
-                        for lbl in labels:
-                            k = lbl
-                            seen[k] = seen.get(k, 0) + 1
-                            uniq.append(k if seen[k] == 1 else f"{k}({seen[k]})")
-                        base_lbl, c1_lbl, c2_lbl = uniq
-
-                        color_map = {
-                            base_lbl: COLORS[0],
-                            c1_lbl: COLORS[1],
-                            c2_lbl: COLORS[2],
-                        }
-
-                        years_int = [int(y) for y in year_cols_sorted]
-                        rows = []
-                        for y in year_cols_sorted:
-                            yi = int(y)
-                            for lbl, ridx in [(base_lbl, int(base_rep["idx"])), (c1_lbl, int(rep1["idx"])), (c2_lbl, int(rep2["idx"]))]:
-                                rv = pd.to_numeric(ranks_by_year[y].at[ridx], errors="coerce")
-                                if pd.notna(rv):
-                                    r = float(rv)
-                                    score = (total_n - r + 1.0)  # 상위일수록 큰 값
-                                    rows.append({"year": yi, "label": lbl, "rank": r, "score": score})
-
-                        df_long = pd.DataFrame(rows)
-
-                        if df_long.empty:
-                            st.warning("막대 레이스 그래프를 그릴 데이터가 없습니다.")
-                        else:
-                            # y축 카테고리 순서를 고정(막대 위치가 연도에 따라 위아래로 바뀌지 않도록)
-                            cat_display = [base_lbl, c1_lbl, c2_lbl]  # 화면에서 위→아래로 보이길 원하는 순서
-                            cat_order = cat_display[::-1]            # Plotly는 (아래→위)로 카테고리를 쌓으므로 역순 사용
-
-                            def _bar_for_year(yy: int):
-                                d = df_long[df_long["year"] == yy].copy()
-                                # 카테고리(막대 위치) 고정: 연도별로 순위가 바뀌어도 위/아래 위치가 변하지 않음
-                                d = d.set_index("label").reindex(cat_order).reset_index()
-                                d["score"] = pd.to_numeric(d["score"], errors="coerce").fillna(0.0)
-                                d["rank"] = pd.to_numeric(d["rank"], errors="coerce")
-
-                                bar = go.Bar(
-                                    x=d["score"],
-                                    y=d["label"],
-                                    orientation="h",
-                                    marker=dict(color=[color_map.get(lbl, "#999999") for lbl in d["label"]]),
-                                    text=[f"{int(r):,}위" if pd.notna(r) else "" for r in d["rank"]],
-                                    textposition="outside",
-                                    textfont=dict(size=14, family="Arial Black"),
-                                    cliponaxis=False,
+                    if np.isnan(rank_sub).all():
+                        st.warning("선택된 단지들에서 연도별 '압구정 전체 순위' 데이터를 찾지 못했습니다.")
+
+                    else:
+                        # 그래프: 레이싱차트(연도별 순위 경쟁)
+                        if str(graph_mode).startswith("레이싱"):
+                            try:
+                                import plotly.graph_objects  # noqa: F401  (설치 여부 확인, 그리기는 race_chart_figure)
+                            except Exception:
+                                st.warning("레이싱차트를 위해 plotly가 필요합니다. requirements.txt에 'plotly'를 추가해 주세요.")
+                                st.stop()  # plotly 미설치 시 레이싱차트를 렌더링할 수 없음
+
+                        if str(graph_mode).startswith("레이싱"):
+                            # -----------------------
+                            # Bar Chart Race (연도별 순위 경쟁)
+                            # -----------------------
+                            total_n = int(len(df_num))
+
+                            def _short_label(u: dict) -> str:
+                                return f"{u.get('complex','')} {u.get('pyeong_fmt','')}".strip()
+
+                            base_lbl = _short_label(base_rep)
+                            c1_lbl = _short_label(rep1)
+                            c2_lbl = _short_label(rep2)
+
+                            # 라벨이 비어있거나 중복되면 최소한의 구분자를 붙입니다.
+                            labels = [base_lbl or "기준", c1_lbl or "비교1", c2_lbl or "비교2"]
+                            base_lbl, c1_lbl, c2_lbl = _uniquify_labels(labels)
+
+                            if np.isnan(rank_sub).all():
+                                st.warning("막대 레이스 그래프를 그릴 데이터가 없습니다.")
+                            else:
+                                is_mobile = infer_device_type() == "mobile"
+                                if is_mobile:
+                                    st.caption("Play 버튼 또는 하단 슬라이더로 연도별 확인")
+
+                                fig_race = race_chart_figure(
+                                    tuple(map(tuple, rank_sub.tolist())),
+                                    years_int_sorted,
+                                    (base_lbl, c1_lbl, c2_lbl),
+                                    tuple(COLORS),
+                                    total_n,
+                                    is_mobile,
                                 )
-                                return bar
-
-                            y0 = years_int[0]
-                            frames = [go.Frame(data=[_bar_for_year(yy)], name=str(yy)) for yy in years_int]
-
-                            is_mobile = infer_device_type() == "mobile"
-
-                            race_title = f"{start_year} → {end_year} 연도별 압구정 전체 순위 경쟁 (3개 단지)"
-                            if is_mobile:
-                                race_title = f"{start_year}→{end_year} 순위 경쟁 (3개 단지)"
-                                st.caption("Play 버튼 또는 하단 슬라이더로 연도별 확인")
-
-                            xaxis_title = "상위 점수" if is_mobile else "상위 점수(높을수록 상위)"
-                            race_height = 420 if is_mobile else 560
-                            race_margin = dict(l=120, r=40, t=120, b=110) if is_mobile else dict(l=190, r=90, t=200, b=145)
-                            y_tickfont = dict(size=13, family="Arial Black") if is_mobile else dict(size=15, family="Arial Black")
-                            slider_y = -0.18 if is_mobile else -0.22
-                            buttons_y = 1.08 if is_mobile else 1.14
-                            title_y = 0.96 if is_mobile else 0.98
-                            fig_race = go.Figure(
-                                data=[_bar_for_year(y0)],
-                                layout=go.Layout(
-                                    title=dict(text=race_title, x=0.0, xanchor="left", y=title_y, yanchor="top"),
-                                    xaxis=dict(title=xaxis_title, range=[0, max(df_long["score"].max(), 1.0) * 1.12], tickfont=dict(size=12), titlefont=dict(size=13)),
-                                    yaxis=dict(title="", automargin=True, categoryorder="array", categoryarray=cat_order, tickfont=y_tickfont),
-                                    margin=race_margin,
-                                    height=race_height,
-                                    font=dict(size=12, family="Malgun Gothic"),
-                                    updatemenus=[
-                                        dict(
-                                            type="buttons",
-                                            direction="left",
-                                            x=0.01, y=buttons_y, xanchor="left", yanchor="bottom",
-                                            buttons=[
-                                                dict(
-                                                    label="Play",
-                                                    method="animate",
-                                                    args=[None, {"frame": {"duration": 700, "redraw": True},
-                                                                 "transition": {"duration": 200},
-                                                                 "fromcurrent": True}],
-                                                ),
-                                                dict(
-                                                    label="Pause",
-                                                    method="animate",
-                                                    args=[[None], {"frame": {"duration": 0, "redraw": False},
-                                                                   "mode": "immediate"}],
-                                                ),
-                                            ],
-                                        )
-                                    ],
-                                    sliders=[
-                                        dict(
-                                            x=0.01, y=slider_y, len=0.98,
-                                            currentvalue=dict(prefix="연도: ", font=dict(size=14, family="Arial Black")),
-                                            steps=[
-                                                dict(
-                                                    method="animate",
-                                                    args=[[str(yy)], {"frame": {"duration": 0, "redraw": True},
-                                                                      "mode": "immediate"}],
-                                                    label=str(yy),
-                                                )
-                                                for yy in years_int
-                                            ],
-                                        )
-                                    ],
-                                ),
-                                frames=frames,
-                            )
-
-                            st.plotly_chart(fig_race, use_container_width=True)
-        else:
-            if not can_compare:
-                st.caption("기준단지/비교단지 1/2의 구역·단지·평형을 모두 선택하면 [비교하기] 버튼이 활성화됩니다.")
+
+                                st.plotly_chart(fig_race, use_container_width=True)
+            else:
+                if not can_compare:
+                    st.caption("기준단지/비교단지 1/2의 구역·단지·평형을 모두 선택하면 [비교하기] 버튼이 활성화됩니다.")
+
+
+render_compare_section(zone, complex_name, dong, ho)